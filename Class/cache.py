@@ -0,0 +1,90 @@
+"""This class caches the detections of frames which were already inferred,
+ keyed by the video content hash with the model weights hash and the
+ frame index, so replayed frames only need to be rendered again. """
+
+import os
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+class DetectionCache:
+
+    ENTRY_OVERHEAD = 256 # approximate bytes of bookkeeping per cached frame
+    INDEX_LOCK = Lock() # serialises read-modify-write of the on-disk indexes
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = Lock()
+
+
+    def get(self, detections_key, frame_index):
+        """
+        Returns the (n, 6) array of [x1, y1, x2, y2, conf, class] rows
+        of the frame, or None if it was never inferred or got evicted
+        """
+        key = (detections_key, frame_index)
+        with self.lock:
+            boxes = self.entries.get(key)
+            if boxes is not None:
+                self.entries.move_to_end(key)
+            return boxes
+
+
+    def put(self, detections_key, frame_index, boxes):
+        key = (detections_key, frame_index)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes + DetectionCache.ENTRY_OVERHEAD
+            self.entries[key] = boxes
+            self.size += boxes.nbytes + DetectionCache.ENTRY_OVERHEAD
+
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes + DetectionCache.ENTRY_OVERHEAD
+
+
+    @staticmethod
+    def save(path, detections):
+        """
+        Writes {frame_index: boxes} to disk column by column: the inferred
+        frame indices, then one row per box with its frame index
+        """
+        frames = np.array(sorted(detections), dtype=np.int64)
+        rows = [detections[frame] for frame in frames]
+        boxes = np.concatenate(rows) if rows else np.zeros((0, 6), dtype=np.float32)
+        box_frames = np.repeat(frames, [len(row) for row in rows])
+
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, frames=frames, box_frames=box_frames, boxes=boxes.astype(np.float32))
+        os.replace(temp_path, path)
+
+
+    @staticmethod
+    def merge(path, detections):
+        """
+        Adds detections to the index on disk, keeping the frames other
+        sessions or jobs on the same video have written meanwhile
+        """
+        with DetectionCache.INDEX_LOCK:
+            merged = DetectionCache.load(path)
+            merged.update(detections)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            DetectionCache.save(path, merged)
+
+
+    @staticmethod
+    def load(path):
+        """
+        Reads back what save() wrote, frames without boxes map to empty arrays
+        """
+        if not os.path.exists(path):
+            return {}
+
+        with np.load(path) as index:
+            frames, box_frames, boxes = index['frames'], index['box_frames'], index['boxes']
+
+        starts = np.searchsorted(box_frames, frames, side='left')
+        ends = np.searchsorted(box_frames, frames, side='right')
+        return {int(frame): boxes[start:end] for frame, start, end in zip(frames, starts, ends)}
@@ -0,0 +1,104 @@
+"""This class decides which frames with detections are worth saving. The
+ detections of consecutive frames are linked into tracks by IoU, and each
+ track only keeps its K most confident frames (plus, optionally, one
+ keyframe every N frames) instead of every frame the polyp is seen on. """
+
+import numpy as np
+
+class Track:
+
+    def __init__(self, label, frame_index, box):
+        self.label = label
+        self.start = frame_index
+        self.last = frame_index
+        self.box = box
+        self.best = [] # [conf, frame_index, image] sorted by decreasing confidence
+
+
+class CapturePolicy:
+
+    def __init__(self, top_k=3, iou_threshold=0.3, max_gap=15, keyframe_interval=None):
+        self.top_k = top_k
+        self.iou_threshold = iou_threshold
+        self.max_gap = max_gap # frames a track survives without a matching box
+        self.keyframe_interval = keyframe_interval
+        self.tracks = []
+        self.saved = set() # frame indices already handed out
+
+
+    @staticmethod
+    def iou(box, boxes):
+        """
+        IoU of one [x1, y1, x2, y2] box against an (n, 4) array of boxes
+        """
+        x1 = np.maximum(box[0], boxes[:, 0])
+        y1 = np.maximum(box[1], boxes[:, 1])
+        x2 = np.minimum(box[2], boxes[:, 2])
+        y2 = np.minimum(box[3], boxes[:, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        union = (box[2] - box[0]) * (box[3] - box[1]) + areas - intersection
+        return intersection / np.maximum(union, 1e-9)
+
+
+    def observe(self, frame_index, boxes, image):
+        """
+        Links the (n, 6) [x1, y1, x2, y2, conf, class] boxes of a frame to
+        the open tracks. Returns the (frame_index, image) pairs to save now:
+        the best frames of the tracks which just ended, and keyframes
+        """
+        to_save = self.close(lambda track: abs(frame_index - track.last) > self.max_gap)
+
+        matched = set()
+        for row in sorted(boxes.tolist(), key=lambda row: -row[4]):
+            box, conf, label = np.array(row[:4]), row[4], int(row[5])
+            candidates = [track for track in self.tracks if track.label == label and id(track) not in matched]
+            overlaps = CapturePolicy.iou(box, np.array([track.box for track in candidates])) if candidates else []
+
+            if len(overlaps) and overlaps.max() >= self.iou_threshold:
+                track = candidates[int(overlaps.argmax())]
+            else:
+                track = Track(label, frame_index, box)
+                self.tracks.append(track)
+            matched.add(id(track))
+
+            track.box = box
+            track.last = frame_index
+            self.keep(track, conf, frame_index, image)
+            if self.keyframe_interval and (frame_index - track.start) % self.keyframe_interval == 0:
+                to_save += self.unsaved([(frame_index, image)])
+
+        return to_save
+
+
+    def keep(self, track, conf, frame_index, image):
+        for best in track.best:
+            if best[1] == frame_index: # replayed frame
+                best[0] = max(best[0], conf)
+                break
+        else:
+            track.best.append([conf, frame_index, image])
+        track.best.sort(key=lambda best: -best[0])
+        del track.best[self.top_k:]
+
+
+    def close(self, ended):
+        closed = [track for track in self.tracks if ended(track)]
+        self.tracks = [track for track in self.tracks if not ended(track)]
+        return self.unsaved([(frame_index, image) for track in closed for _, frame_index, image in track.best])
+
+
+    def unsaved(self, frames):
+        to_save = []
+        for frame_index, image in frames:
+            if frame_index not in self.saved:
+                self.saved.add(frame_index)
+                to_save.append((frame_index, image))
+        return to_save
+
+
+    def flush(self):
+        """
+        Ends every open track, called when the session ends
+        """
+        return self.close(lambda track: True)
@@ -0,0 +1,113 @@
+"""This class stores the feedback samples used for retraining. Sample ids are
+ allocated atomically, each image and label file is written once, and an
+ append-only index (manifest.jsonl) lists every sample with its sampling
+ weight, label count and source video/frame. """
+
+import os
+import re
+import json
+import time
+from threading import Lock
+from PIL import Image
+
+class FeedbackStore:
+
+    INDEX = 'manifest.jsonl'
+    LEGACY_COUNTER = 'count_frames.txt'
+    stores = {}
+    registry_lock = Lock()
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = Lock()
+        os.makedirs(os.path.join(folder, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(folder, 'labels'), exist_ok=True)
+        self.next_id = self.last_id() + 1
+
+
+    @classmethod
+    def open(cls, folder):
+        with cls.registry_lock:
+            if folder not in cls.stores:
+                cls.stores[folder] = cls(folder)
+            return cls.stores[folder]
+
+
+    @property
+    def index_path(self):
+        return os.path.join(self.folder, FeedbackStore.INDEX)
+
+
+    def last_id(self):
+        """
+        Highest sample id in the index, or in the counter file
+        written by older versions of the feedback folder
+        """
+        last = 0
+        counter_path = os.path.join(self.folder, FeedbackStore.LEGACY_COUNTER)
+        if os.path.exists(counter_path):
+            with open(counter_path, 'r') as file:
+                last = int(file.read().strip() or 0)
+
+        for sample in self.samples():
+            match = re.search(r'(\d+)\.jpg$', sample['image'])
+            last = max(last, sample.get('id') or (int(match.group(1)) if match else 0))
+        return last
+
+
+    def samples(self):
+        """
+        Enumerates the index, which only lists complete samples
+        """
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'r') as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+
+    def allocate(self):
+        """
+        Claims the next sample id by creating its label file exclusively,
+        which also keeps ids unique between server processes
+        """
+        with self.lock:
+            while True:
+                sample_id = self.next_id
+                self.next_id += 1
+                label_path = os.path.join(self.folder, 'labels', f"{sample_id}.txt")
+                try:
+                    return sample_id, os.open(label_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    continue
+
+
+    def add(self, image, label_lines, weight, source):
+        """
+        Stores an RGB frame with its YOLO label lines. The index entry is
+        appended last, in a single O_APPEND write, once both files exist
+        """
+        sample_id, label_fd = self.allocate()
+        with os.fdopen(label_fd, 'w') as file:
+            file.write(''.join(f"{line}\n" for line in label_lines))
+
+        image_path = os.path.join(self.folder, 'images', f"{sample_id}.jpg")
+        Image.fromarray(image).save(f"{image_path}.tmp", format="jpeg")
+        os.replace(f"{image_path}.tmp", image_path)
+
+        sample = {
+            "id":sample_id,
+            "image":f"images/{sample_id}.jpg",
+            "label":f"labels/{sample_id}.txt",
+            "weight":weight,
+            "labels":len(label_lines),
+            "video":source.get("video"),
+            "frame":source.get("frame"),
+            "room":source.get("room"),
+            "time":round(time.time(), 3)
+        }
+        index_fd = os.open(self.index_path, os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o644)
+        try:
+            os.write(index_fd, (json.dumps(sample) + '\n').encode())
+        finally:
+            os.close(index_fd)
+        return sample_id
@@ -0,0 +1,104 @@
+"""This class finds the field of view of an endoscopy video: the circular or
+ octagonal image area inside the black borders and on-screen overlays.
+ A few frames spread over the video are thresholded, thin overlays are
+ opened away and the largest bright region is kept. Frames are cropped
+ to it before inference, at the scale the full frame would have had, so
+ the model input shrinks by the black margins. The boxes are moved back
+ to full frame coordinates afterwards. """
+
+import cv2
+import numpy as np
+from Class.storage import Storage
+
+class FieldOfView:
+
+    SAMPLES = 8 # frames looked at
+    THRESHOLD = 20 # gray level above which a pixel shows tissue
+    MARGIN = 0.02 # of the frame size added around the region
+    MIN_GAIN = 0.1 # share of the frame which must be cut for the crop to be worth it
+
+    def __init__(self, x, y, width, height, frame_width, frame_height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+
+
+    @classmethod
+    def for_video(cls, video_path):
+        """
+        Returns the field of view of a stored video, None if the whole
+        frame is in use. It is detected once and kept in the metadata
+        """
+        region = Storage.cached_metadata(video_path, 'field_of_view', lambda: cls.detect(video_path))
+        return cls(*region) if region else None
+
+
+    @staticmethod
+    def samples(video_path):
+        cap = cv2.VideoCapture(video_path)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frames = []
+        for frame_index in np.linspace(0, max(0, frame_count - 1), FieldOfView.SAMPLES).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_index))
+            ret, frame = cap.read()
+            if ret:
+                frames.append(frame)
+        cap.release()
+        return frames
+
+
+    @staticmethod
+    def detect(video_path):
+        """
+        Returns the [x, y, width, height] of the image area followed by the
+        frame width and height, None when there is nothing worth cropping
+        (or nothing could be read)
+        """
+        frames = FieldOfView.samples(video_path)
+        if not frames:
+            return None
+
+        # a pixel is active if it shows tissue in at least half of the samples
+        active = np.mean([frame.max(axis=2) > FieldOfView.THRESHOLD for frame in frames], axis=0) >= 0.5
+        frame_height, frame_width = active.shape
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
+        mask = cv2.morphologyEx(active.astype(np.uint8), cv2.MORPH_OPEN, kernel)
+
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        if count < 2:
+            return None
+        x, y, width, height, _ = stats[1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])]
+
+        margin_x, margin_y = int(frame_width * FieldOfView.MARGIN), int(frame_height * FieldOfView.MARGIN)
+        x1, y1 = max(0, x - margin_x), max(0, y - margin_y)
+        x2, y2 = min(frame_width, x + width + margin_x), min(frame_height, y + height + margin_y)
+        if (x2 - x1) * (y2 - y1) > (1 - FieldOfView.MIN_GAIN) * frame_width * frame_height:
+            return None
+        return [int(x1), int(y1), int(x2 - x1), int(y2 - y1), frame_width, frame_height]
+
+
+    def input_size(self, frame_size):
+        """
+        Long side to run the model at on the crop, so it keeps the scale
+        the full frame gets at frame_size (AutoShape scales every input
+        to its long side, the crop would otherwise be enlarged)
+        """
+        scale = max(self.width, self.height) / max(self.frame_width, self.frame_height)
+        return max(32, round(frame_size * scale))
+
+
+    def crop(self, rgb_frame):
+        return rgb_frame[self.y:self.y + self.height, self.x:self.x + self.width]
+
+
+    def to_frame(self, boxes):
+        """
+        Moves [x1, y1, x2, y2, ...] boxes of the crop to full frame coordinates
+        """
+        boxes = boxes.copy()
+        boxes[:, [0, 2]] += self.x
+        boxes[:, [1, 3]] += self.y
+        return boxes
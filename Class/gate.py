@@ -0,0 +1,52 @@
+"""This class skips inference on frames which barely differ from the last
+ frame that got detections. Frames are compared as small grayscale
+ thumbnails (mean absolute difference), which costs a fraction of a
+ millisecond, and a reference is reused a limited number of times so
+ the boxes shown are never more than a few frames stale. """
+
+import cv2
+import numpy as np
+
+class MotionGate:
+
+    SIZE = 32 # side of the thumbnails compared
+
+    def __init__(self, threshold=2.0, max_reuse=5):
+        self.threshold = threshold # mean absolute difference (0-255) under which a frame is a near-duplicate
+        self.max_reuse = max_reuse
+        self.reference = None
+        self.reference_index = None
+        self.boxes = None
+        self.reused = 0
+
+
+    @staticmethod
+    def thumbnail(rgb_frame):
+        small = cv2.resize(rgb_frame, (MotionGate.SIZE, MotionGate.SIZE), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_RGB2GRAY).astype(np.int16)
+
+
+    def reuse(self, frame_index, rgb_frame):
+        """
+        Returns the boxes of the reference frame if this frame follows it
+        and barely changed, None when detections are needed
+        """
+        if (self.reference is None or frame_index != self.reference_index + self.reused + 1
+                or self.reused >= self.max_reuse):
+            return None
+
+        if np.abs(MotionGate.thumbnail(rgb_frame) - self.reference).mean() > self.threshold:
+            return None
+
+        self.reused += 1
+        return self.boxes
+
+
+    def update(self, frame_index, rgb_frame, boxes):
+        """
+        Makes the frame the reference, with the boxes it got
+        """
+        self.reference = MotionGate.thumbnail(rgb_frame)
+        self.reference_index = frame_index
+        self.boxes = boxes
+        self.reused = 0
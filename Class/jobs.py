@@ -0,0 +1,188 @@
+"""This class analyses a whole uploaded video in the background. The video
+ is decoded in parallel segments whose frames go through the batching
+ inference scheduler at background priority, behind the frames of live
+ sessions, and the per-frame detections are written to the
+ columnar detection index of the video, which playback then reads
+ instead of running the model. """
+
+import sys
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+import cv2
+from Class.cache import DetectionCache
+from Class.fov import FieldOfView
+from Class.storage import Storage
+from Class.timeline import DetectionTimeline
+
+class AnalysisJob:
+
+    SEGMENTS = 4 # parallel decoders per job
+    IN_FLIGHT = 8 # frames each decoder keeps queued for inference
+    IN_FLIGHT_WITH_SESSIONS = 2 # while live sessions are running
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    RETENTION = 3600 # seconds a finished job stays listed
+    MAX_FINISHED = 100 # finished jobs listed at most
+    jobs = {}
+    lock = Lock()
+
+    def __init__(self, video_path, metadata, scheduler, detections_key, index_path, crop_field_of_view=False):
+        self.job_id = uuid.uuid4().hex
+        self.video_path = video_path
+        self.crop_field_of_view = crop_field_of_view
+        self.video_hash = metadata['hash']
+        self.total_frames = metadata.get('frame_count', 0)
+        self.scheduler = scheduler
+        self.detections_key = detections_key # video and model weights the detections belong to
+        self.index_path = index_path
+        self.detections = {}
+        self.indexed_frames = None # frame count kept once the detections are written and dropped
+        self.timeline = None
+        self.fov = None
+        self.inferred_frames = 0
+        self.state = AnalysisJob.QUEUED
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.lock = Lock()
+
+
+    @classmethod
+    def start(cls, video_path, metadata, scheduler, detections_key, index_path, crop_field_of_view=False):
+        """
+        Starts the job on its own thread. The job holds a reference on the
+        stored video (taken by the caller) and releases it when it ends
+        """
+        job = cls(video_path, metadata, scheduler, detections_key, index_path, crop_field_of_view)
+        with cls.lock:
+            cls.prune()
+            cls.jobs[job.job_id] = job
+        Thread(target=job.run, daemon=True).start()
+        return job
+
+
+    @classmethod
+    def prune(cls):
+        """
+        Forgets the jobs finished more than RETENTION seconds ago and the
+        oldest finished ones beyond MAX_FINISHED. Called under the lock
+        """
+        now = time.monotonic()
+        finished = sorted((job for job in cls.jobs.values() if job.finished), key=lambda job: job.finished)
+        for position, job in enumerate(finished):
+            if now - job.finished > AnalysisJob.RETENTION or len(finished) - position > AnalysisJob.MAX_FINISHED:
+                del cls.jobs[job.job_id]
+
+
+    @classmethod
+    def get(cls, job_id):
+        with cls.lock:
+            return cls.jobs.get(job_id)
+
+
+    @classmethod
+    def all(cls):
+        with cls.lock:
+            return list(cls.jobs.values())
+
+
+    def segments(self):
+        if not self.total_frames:
+            return [(0, sys.maxsize)] # unknown length, a single decoder reads to the end
+
+        count = min(AnalysisJob.SEGMENTS, self.total_frames)
+        bounds = [round(i * self.total_frames / count) for i in range(count + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+    def collect(self, frame_index, future):
+        boxes = future.result().pred[0].cpu().numpy()
+        if self.fov:
+            boxes = self.fov.to_frame(boxes)
+        with self.lock:
+            self.detections[frame_index] = boxes
+            self.inferred_frames += 1
+        self.timeline.add(frame_index, boxes)
+
+
+    def analyse_segment(self, segment):
+        start, end = segment
+        cap = cv2.VideoCapture(self.video_path)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        pending = deque()
+
+        for frame_index in range(start, end):
+            if frame_index in self.detections: # indexed by an earlier session or job
+                if not cap.grab():
+                    break
+                continue
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            if self.fov:
+                image, size = self.fov.crop(rgb_frame), self.fov.input_size(self.scheduler.INPUT_SIZE)
+            else:
+                image, size = rgb_frame, self.scheduler.INPUT_SIZE
+            pending.append((frame_index, self.scheduler.submit(image, size, self.scheduler.BACKGROUND)))
+            in_flight = AnalysisJob.IN_FLIGHT_WITH_SESSIONS if self.scheduler.sessions else AnalysisJob.IN_FLIGHT
+            while len(pending) >= in_flight:
+                self.collect(*pending.popleft())
+
+        while pending:
+            self.collect(*pending.popleft())
+        cap.release()
+
+
+    def run(self):
+        self.started = time.monotonic()
+        self.state = AnalysisJob.RUNNING
+        self.detections = DetectionCache.load(self.index_path)
+        self.timeline = DetectionTimeline.for_video(self.detections_key, load=lambda: self.detections)
+        segments = self.segments()
+
+        try:
+            self.fov = FieldOfView.for_video(self.video_path) if self.crop_field_of_view else None
+            with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                list(pool.map(self.analyse_segment, segments))
+            DetectionCache.merge(self.index_path, self.detections)
+            self.state = AnalysisJob.DONE
+        except Exception as error:
+            self.error = str(error)
+            self.state = AnalysisJob.FAILED
+        finally:
+            # written to the index by now (or lost with the failure), only their count is kept for status()
+            with self.lock:
+                self.indexed_frames = len(self.detections)
+                self.detections = {}
+            self.timeline = None
+            self.fov = None
+            if Storage.release_video(self.video_path):
+                DetectionTimeline.evict(self.detections_key)
+            self.finished = time.monotonic()
+
+
+    def status(self):
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0
+        with self.lock:
+            indexed_frames = len(self.detections) if self.indexed_frames is None else self.indexed_frames
+            inferred_frames = self.inferred_frames
+
+        return {
+            "job_id":self.job_id,
+            "hash":self.video_hash,
+            "state":self.state,
+            "frames":indexed_frames,
+            "total_frames":self.total_frames,
+            "progress":round(indexed_frames / self.total_frames, 4) if self.total_frames else None,
+            "elapsed":round(elapsed, 2),
+            "fps":round(inferred_frames / elapsed, 2) if elapsed else 0.0,
+            "error":self.error
+        }
@@ -0,0 +1,171 @@
+"""This class records how long every frame of a session spends in each
+ pipeline stage (decode, queue waits, batching, pre-process, forward, NMS,
+ render, encode, emit) as histograms, along with frame and dropped-frame
+ counters, where the boxes of each frame came from and a rolling FPS,
+ and renders them for Prometheus. Recording is a bucket increment under
+ an uncontended lock, cheap enough to stay on. """
+
+import time
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+
+class SessionMetrics:
+
+    STAGES = ('decode', 'queue_wait', 'batch_wait', 'preprocess', 'forward', 'nms', 'render', 'encode', 'emit')
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5) # seconds
+    SOURCES = ('model', 'cache', 'tracked', 'reused') # where the boxes of a frame came from
+    FPS_WINDOW = 5 # seconds the rolling FPS is measured over
+    sessions = {}
+    registry_lock = Lock()
+
+    def __init__(self, room):
+        self.room = room
+        self.counts = {stage: [0] * (len(SessionMetrics.BUCKETS) + 1) for stage in SessionMetrics.STAGES}
+        self.sums = {stage: 0.0 for stage in SessionMetrics.STAGES}
+        self.frames = 0
+        self.dropped = 0
+        self.detections = {source: 0 for source in SessionMetrics.SOURCES}
+        self.emitted = deque() # emit times inside the FPS window
+        self.lock = Lock()
+
+
+    @classmethod
+    def for_room(cls, room):
+        with cls.registry_lock:
+            if room not in cls.sessions:
+                cls.sessions[room] = cls(room)
+            return cls.sessions[room]
+
+
+    @classmethod
+    def remove(cls, room):
+        with cls.registry_lock:
+            cls.sessions.pop(room, None)
+
+
+    def observe(self, stage, seconds):
+        bucket = bisect_left(SessionMetrics.BUCKETS, seconds)
+        with self.lock:
+            self.counts[stage][bucket] += 1
+            self.sums[stage] += seconds
+
+
+    def count_dropped(self, frames=1):
+        with self.lock:
+            self.dropped += frames
+
+
+    def count_detection(self, source):
+        with self.lock:
+            self.detections[source] += 1
+
+
+    def skipped_ratio(self):
+        """
+        Share of the frames whose boxes did not need a model forward
+        """
+        total = sum(self.detections.values())
+        return (total - self.detections['model']) / total if total else 0.0
+
+
+    def count_frame(self):
+        now = time.monotonic()
+        with self.lock:
+            self.frames += 1
+            self.emitted.append(now)
+            while self.emitted[0] < now - SessionMetrics.FPS_WINDOW:
+                self.emitted.popleft()
+
+
+    def fps(self):
+        with self.lock:
+            while self.emitted and self.emitted[0] < time.monotonic() - SessionMetrics.FPS_WINDOW:
+                self.emitted.popleft()
+            return len(self.emitted) / SessionMetrics.FPS_WINDOW
+
+
+    @staticmethod
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+    def samples(self):
+        """
+        Returns the histogram lines of the session, then its frames,
+        dropped frames and FPS lines, its detection source lines and
+        its skipped inference ratio line
+        """
+        room = SessionMetrics.label(self.room)
+        fps = self.fps()
+        histograms = []
+
+        with self.lock:
+            for stage in SessionMetrics.STAGES:
+                cumulative = 0
+                for bound, count in zip(SessionMetrics.BUCKETS + ('+Inf',), self.counts[stage]):
+                    cumulative += count
+                    histograms.append(f'gastrogenius_stage_seconds_bucket{{room="{room}",stage="{stage}",le="{bound}"}} {cumulative}')
+                histograms.append(f'gastrogenius_stage_seconds_sum{{room="{room}",stage="{stage}"}} {self.sums[stage]}')
+                histograms.append(f'gastrogenius_stage_seconds_count{{room="{room}",stage="{stage}"}} {cumulative}')
+            return (histograms,
+                    f'gastrogenius_frames_total{{room="{room}"}} {self.frames}',
+                    f'gastrogenius_dropped_frames_total{{room="{room}"}} {self.dropped}',
+                    f'gastrogenius_fps{{room="{room}"}} {fps}',
+                    [f'gastrogenius_detections_total{{room="{room}",source="{source}"}} {count}'
+                     for source, count in self.detections.items()],
+                    f'gastrogenius_skipped_inference_ratio{{room="{room}"}} {self.skipped_ratio()}')
+
+
+    @classmethod
+    def exposition(cls, startup=None):
+        """
+        Renders the metrics of every room in the Prometheus text format,
+        followed by the timings of the model load if given (step -> seconds,
+        plus 'cache_hit')
+        """
+        with cls.registry_lock:
+            sessions = list(cls.sessions.values())
+
+        histograms, frames, dropped, fps, detections, skipped = [], [], [], [], [], []
+        for session in sessions:
+            (session_histograms, session_frames, session_dropped, session_fps,
+             session_detections, session_skipped) = session.samples()
+            histograms += session_histograms
+            frames.append(session_frames)
+            dropped.append(session_dropped)
+            fps.append(session_fps)
+            detections += session_detections
+            skipped.append(session_skipped)
+
+        lines = [
+            '# HELP gastrogenius_stage_seconds Time a frame spends in each pipeline stage',
+            '# TYPE gastrogenius_stage_seconds histogram',
+            *histograms,
+            '# HELP gastrogenius_frames_total Frames sent to the room',
+            '# TYPE gastrogenius_frames_total counter',
+            *frames,
+            '# HELP gastrogenius_dropped_frames_total Frames skipped to keep up with the wall clock',
+            '# TYPE gastrogenius_dropped_frames_total counter',
+            *dropped,
+            '# HELP gastrogenius_fps Frames sent to the room per second, over the last seconds',
+            '# TYPE gastrogenius_fps gauge',
+            *fps,
+            '# HELP gastrogenius_detections_total Frames by where their boxes came from (model, cache, tracked, reused)',
+            '# TYPE gastrogenius_detections_total counter',
+            *detections,
+            '# HELP gastrogenius_skipped_inference_ratio Share of the frames which did not need a model forward',
+            '# TYPE gastrogenius_skipped_inference_ratio gauge',
+            *skipped
+        ]
+        if startup:
+            lines += [
+                '# HELP gastrogenius_startup_seconds Time each step of the model load took at boot',
+                '# TYPE gastrogenius_startup_seconds gauge',
+                *[f'gastrogenius_startup_seconds{{step="{step}"}} {seconds}'
+                  for step, seconds in startup.items() if step != 'cache_hit'],
+                '# HELP gastrogenius_startup_cache_hit Whether the fused model was loaded from the cache at boot',
+                '# TYPE gastrogenius_startup_cache_hit gauge',
+                f'gastrogenius_startup_cache_hit {int(startup.get("cache_hit", False))}'
+            ]
+        return '\n'.join(lines) + '\n'
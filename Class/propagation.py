@@ -0,0 +1,115 @@
+"""This class lets a session run the model on keyframes only. On the frames
+ in between, the boxes of the previous frame are moved along the sparse
+ optical flow of the features inside them. The model runs again after
+ the stride, or earlier as soon as a box loses its features, the camera
+ moves too fast or playback jumps. In adaptive mode the stride grows
+ while keyframes agree with the tracked boxes and falls back to 1 when
+ they do not. """
+
+import cv2
+import numpy as np
+from Class.capture import CapturePolicy
+
+class DetectionPropagator:
+
+    FLOW_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                       criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+    GRID = 8 # points per side of the grid measuring the camera motion
+
+    def __init__(self, max_stride=5, adaptive=False, max_motion=20.0, min_tracked=0.5, min_iou=0.5):
+        self.max_stride = max_stride
+        self.adaptive = adaptive
+        self.stride = 1 if adaptive else max_stride
+        self.max_motion = max_motion # pixels of median camera motion between two frames
+        self.min_tracked = min_tracked # share of the features of a box which must be found again
+        self.min_iou = min_iou # keyframe and tracked box overlap needed to call them in agreement
+        self.previous_index = None
+        self.previous_gray = None
+        self.previous_boxes = None
+        self.since_keyframe = 0
+
+
+    def flow(self, points, gray):
+        """
+        Moves the points from the previous frame to this one, returns the
+        points found again and the displacement of each of them
+        """
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points, None,
+                                                   **DetectionPropagator.FLOW_PARAMS)
+        found = status.reshape(-1) == 1
+        return found, (moved - points).reshape(-1, 2)[found]
+
+
+    def grid(self, shape):
+        height, width = shape
+        xs = np.linspace(width * 0.1, width * 0.9, DetectionPropagator.GRID)
+        ys = np.linspace(height * 0.1, height * 0.9, DetectionPropagator.GRID)
+        return np.array([[[x, y]] for y in ys for x in xs], dtype=np.float32)
+
+
+    def propagate(self, frame_index, rgb_frame):
+        """
+        Returns the boxes of the frame tracked from the previous frame,
+        or None when the model has to run on it
+        """
+        if (self.previous_gray is None or frame_index != self.previous_index + 1
+                or self.since_keyframe + 1 >= self.stride):
+            return None
+
+        gray = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY)
+        found, motion = self.flow(self.grid(gray.shape), gray)
+        if found.mean() < self.min_tracked or np.linalg.norm(np.median(motion, axis=0)) > self.max_motion:
+            return None
+
+        boxes = self.previous_boxes.copy()
+        for box in boxes:
+            x1, y1, x2, y2 = box[:4].astype(int)
+            mask = np.zeros_like(gray)
+            mask[max(0, y1):y2, max(0, x1):x2] = 255
+            points = cv2.goodFeaturesToTrack(self.previous_gray, maxCorners=20, qualityLevel=0.01,
+                                             minDistance=5, mask=mask)
+            if points is None or len(points) < 4:
+                return None
+            found, motion = self.flow(points, gray)
+            if found.mean() < self.min_tracked:
+                return None
+            box[[0, 2]] += np.median(motion[:, 0])
+            box[[1, 3]] += np.median(motion[:, 1])
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, gray.shape[1])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, gray.shape[0])
+
+        self.remember(frame_index, gray, boxes)
+        self.since_keyframe += 1
+        return boxes
+
+
+    def keyframe(self, frame_index, rgb_frame, boxes):
+        """
+        Records the boxes the model (or the cache) returned for a frame
+        """
+        if self.adaptive:
+            tracked = self.previous_boxes if self.previous_index == frame_index - 1 else None
+            self.stride = min(self.max_stride, self.stride * 2) if self.agrees(tracked, boxes) else 1
+        self.remember(frame_index, cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY), boxes)
+        self.since_keyframe = 0
+
+
+    def hold(self, frame_index):
+        """
+        The frame reused the boxes of the previous one, tracking goes on
+        from the last frame it saw
+        """
+        self.previous_index = frame_index
+        self.since_keyframe += 1
+
+
+    def agrees(self, tracked, boxes):
+        if tracked is None or len(tracked) != len(boxes):
+            return False
+        return all(CapturePolicy.iou(box[:4], tracked[:, :4]).max() >= self.min_iou for box in boxes)
+
+
+    def remember(self, frame_index, gray, boxes):
+        self.previous_index = frame_index
+        self.previous_gray = gray
+        self.previous_boxes = boxes.astype(np.float32)
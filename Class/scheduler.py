@@ -0,0 +1,141 @@
+"""This class gathers the frames of every live session into micro-batches
+ so the shared model runs one batched forward instead of many single ones.
+ Several worker threads split the CPU cores between their torch thread
+ pools. The workers share the weights but each has its own Detect head
+ grids, as the head rebuilds them in place whenever the input shape
+ changes and two concurrent forwards of different shapes would corrupt
+ each other.
+ Frames of live sessions go first, background frames (analysis jobs)
+ are only batched when no live frame waits, in small batches while
+ sessions are running. """
+
+import os
+import copy
+import time
+import torch
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+
+class InferenceScheduler:
+
+    INPUT_SIZE = 640 # long side AutoShape scales the frames to
+    LIVE = 'live'
+    BACKGROUND = 'background'
+    BACKGROUND_BATCH_WITH_SESSIONS = 2 # background batch size while live sessions run
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=15, workers=1):
+        self.model = model
+        self.models = [model] + [InferenceScheduler.worker_model(model) for _ in range(workers - 1)]
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = {InferenceScheduler.LIVE: deque(), InferenceScheduler.BACKGROUND: deque()}
+        self.sessions = 0
+        self.lock = Lock()
+        self.available = Condition(self.lock)
+        self.gather_lock = Lock()
+        self.threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        self.threads = [Thread(target=self.run, args=(worker_model,), daemon=True) for worker_model in self.models]
+        for thread in self.threads:
+            thread.start()
+
+
+    @staticmethod
+    def worker_model(model):
+        """
+        Returns a model sharing every weight of the given AutoShape model
+        but the Detect head grids. The modules down to the head are
+        shallow copies with their own children, the head gets empty grids
+        """
+        chain = [model]
+        while not isinstance(chain[-1], torch.nn.Sequential):
+            chain.append(chain[-1].model)
+
+        head = copy.copy(chain[-1][-1])
+        head.grid = [torch.empty(0) for _ in range(head.nl)]
+        head.anchor_grid = [torch.empty(0) for _ in range(head.nl)]
+
+        child, name = head, list(chain[-1]._modules)[-1]
+        for module in reversed(chain):
+            clone = copy.copy(module)
+            clone._modules = module._modules.copy()
+            clone._modules[name] = child
+            child, name = clone, 'model'
+        return child
+
+
+    def register(self):
+        """
+        Marks a session as active, a batch is dispatched without waiting
+        as soon as it holds one frame from every active session
+        """
+        with self.lock:
+            self.sessions += 1
+
+
+    def unregister(self):
+        with self.lock:
+            self.sessions = max(0, self.sessions - 1)
+
+
+    def submit(self, image, size=INPUT_SIZE, priority=LIVE):
+        """
+        Queues an RGB frame for inference at the given input long side
+        and returns a future which resolves to the Detections of that
+        frame alone
+        """
+        future = Future()
+        with self.available:
+            self.pending[priority].append((image, future, time.monotonic(), size))
+            self.available.notify()
+        return future
+
+
+    def next_batch(self):
+        """
+        Gathers requests of the same priority and input size, the others
+        wait for the next batch. Only called under gather_lock
+        """
+        live, background = self.pending[InferenceScheduler.LIVE], self.pending[InferenceScheduler.BACKGROUND]
+        with self.available:
+            self.available.wait_for(lambda: live or background)
+            pending = live if live else background
+            batch = [pending.popleft()]
+            deadline, size = batch[0][2] + self.max_wait, batch[0][3]
+            if pending is live:
+                batch_size = min(self.max_batch_size, max(1, self.sessions))
+            elif self.sessions:
+                batch_size = min(self.max_batch_size, InferenceScheduler.BACKGROUND_BATCH_WITH_SESSIONS)
+            else:
+                batch_size = self.max_batch_size
+
+            while True:
+                for request in list(pending):
+                    if len(batch) < batch_size and request[3] == size:
+                        pending.remove(request)
+                        batch.append(request)
+
+                timeout = deadline - time.monotonic()
+                # a live frame arriving never waits for a background batch to fill
+                if len(batch) >= batch_size or timeout <= 0 or (pending is background and live):
+                    return batch
+                self.available.wait(timeout)
+
+
+    def run(self, model):
+        # the intra-op thread count is per calling thread, each worker gets its share of the cores
+        torch.set_num_threads(self.threads_per_worker)
+        while True:
+            # one worker gathers the next batch while the others run their forward
+            with self.gather_lock:
+                batch = self.next_batch()
+            images = [image for image, _, _, _ in batch]
+            try:
+                results = model(images, size=batch[0][3]).tolist()
+            except Exception as error:
+                for _, future, _, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            for (_, future, _, _), result in zip(batch, results):
+                future.set_result(result)
@@ -1,12 +1,26 @@
-import io
 import os
 import base64
-from threading import Lock
-from segmentation import get_yolov5
+from threading import Condition, Lock
+from collections import deque
+from segmentation import get_yolov5, detections_from_boxes
+from Class.cache import DetectionCache
+from Class.capture import CapturePolicy
+from Class.metrics import SessionMetrics
+from Class.propagation import DetectionPropagator
+from Class.gate import MotionGate
+from Class.fov import FieldOfView
+from Class.scheduler import InferenceScheduler
+from Class.storage import Storage
+from Class.timeline import DetectionTimeline
+from Class.video import VideoReader
+from Class.writer import FrameWriter
 import cv2
-import random
-from PIL import Image
-from multiprocessing import Process
+import struct
+import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread
 import zipfile
 
 class Server:
@@ -15,26 +29,72 @@ class Server:
     UPLOAD_FOLDER = 'uploads'
     FEEDBACK_FOLDER = 'feedback'
     FOOTAGE_FOLDER = 'pictures'
+    DETECTIONS_FOLDER = 'detections'
+    PERSIST_DETECTIONS = True # keep the detections of every video on disk, keyed by its content hash
+    PIPELINE_DEPTH = 4 # frames buffered between the decode, inference and emit stages
+    LIVE_MODE = 'live' # follows the wall clock, stale frames are dropped
+    REVIEW_MODE = 'review' # every frame is processed in order
+    DEFAULT_FPS = 30
+    JPEG_QUALITY = 75
+    FRAME_OUTPUT = 'frames' # rendered frames are streamed to the room
+    DETECTIONS_OUTPUT = 'detections' # only boxes are streamed, the client draws the overlay
+    MAX_SESSIONS = 16 # sessions running at once, later ones wait for a free worker
+    INFERENCE_WORKERS = 2 # concurrent batched forwards sharing the model weights
+    PLAYING = 'playing'
+    PAUSED = 'paused'
+    STOPPED = 'stopped'
     MODEL = get_yolov5()
+    SCHEDULER = InferenceScheduler(MODEL, max_batch_size=8, max_wait_ms=15, workers=INFERENCE_WORKERS)
+    SESSIONS = ThreadPoolExecutor(max_workers=MAX_SESSIONS, thread_name_prefix='session')
+    DETECTION_CACHE = DetectionCache(max_bytes=64 * 1024 * 1024)
+    PICTURE_QUEUE_POLICY = FrameWriter.DROP # what saving does when the writers fall behind
+    FRAME_WRITER = FrameWriter(workers=2, max_queued=64, policy=PICTURE_QUEUE_POLICY)
+    CAPTURE_TOP_K = 3 # frames saved per polyp track
+    CAPTURE_KEYFRAME_INTERVAL = None # also save one frame every N frames of a track when set
+    DETECTION_STRIDE = 1 # run the model every N frames and track the boxes in between, 1 disables it
+    ADAPTIVE_STRIDE = 'auto' # stride option growing up to MAX_ADAPTIVE_STRIDE while tracking holds
+    MAX_ADAPTIVE_STRIDE = 8
+    MOTION_THRESHOLD = 0 # mean thumbnail difference under which the previous boxes are reused, 0 disables it (2.0 is a good start)
+    MAX_REUSE = 5 # frames in a row which may reuse the same boxes
+    CROP_FIELD_OF_VIEW = False # run the model on the image area only, without the black borders
 
     def __init__(self, room, video_path, socketio):
         self.room = room
         self.video_path = video_path
-        self.stop_extraction_flag = False
-        self.pause_extracting_flag = False
-        self.reverse_frame = False
-        self.forward_frame = False
+        self.state = Server.PLAYING
+        self.steps = deque() # pending (relative, frame) moves: Forward/Reverse steps and seeks
         self.current_frame_index = 0
         self.frame_height = 0
         self.frame_width = 0
         self.current_frame = None
+        self.displayed_frame_index = 0
         self.current_labels = []
         self.detected_frames = []
         self.thread = None
         self.lock = Lock()
+        self.condition = Condition(self.lock)
         self.diagnosis = None
         self.socket = socketio
         self.save_picture = False
+        self.mode = Server.REVIEW_MODE
+        self.dropped_frames = 0
+        self.dropped_pictures = 0
+        self.capture = None
+        self.metrics = SessionMetrics.for_room(room)
+        self.detection_stride = Server.DETECTION_STRIDE
+        self.propagator = None
+        self.motion_threshold = Server.MOTION_THRESHOLD
+        self.gate = None
+        self.fov = None
+        self.crop_field_of_view = Server.CROP_FIELD_OF_VIEW
+        self.binary_frames = False
+        self.frame_stats = False # Frame_Stats after every frame in review mode too
+        self.jpeg_quality = Server.JPEG_QUALITY
+        self.output = Server.FRAME_OUTPUT
+        self.video_hash = None
+        self.detections_key = None
+        self.detections = {}
+        self.timeline = None
 
 
     @staticmethod
@@ -50,114 +110,497 @@ class Server:
         pass
 
 
+    def reset(self):
+        """
+        Puts the session back in the playing state for a new video
+        """
+        with self.condition:
+            self.state = Server.PLAYING
+            self.steps.clear()
+            self.condition.notify_all()
+
+
     def stop_thread(self):
-        with self.lock:
-            self.stop_extraction_flag = True
+        self.stop()
+
+
+    def step(self, direction):
+        with self.condition:
+            if self.state != Server.STOPPED:
+                self.state = Server.PAUSED
+                self.steps.append((True, direction))
+                self.condition.notify_all()
+
+
+    def seek(self, frame_index):
+        """
+        Pauses the session on the given frame
+        """
+        with self.condition:
+            if self.state != Server.STOPPED:
+                self.state = Server.PAUSED
+                self.steps.append((False, frame_index))
+                self.condition.notify_all()
 
 
     def reverse(self):
-        with self.lock:
-            self.reverse_frame = True
-            self.forward_frame = False
-            self.pause_extracting_flag = True
+        self.step(-1)
 
 
     def forward(self):
-        with self.lock:
-            self.reverse_frame = False
-            self.forward_frame = True
-            self.pause_extracting_flag = True
+        self.step(1)
 
 
     def pause(self):
-        with self.lock:
-            self.pause_extracting_flag = True
+        with self.condition:
+            if self.state == Server.PLAYING:
+                self.state = Server.PAUSED
+                self.condition.notify_all()
 
 
     def unpause(self):
-        with self.lock:
-            self.pause_extracting_flag = False
+        with self.condition:
+            if self.state == Server.PAUSED:
+                self.state = Server.PLAYING
+                self.steps.clear()
+                self.condition.notify_all()
 
 
     def stop(self):
-        with self.lock:
-            self.stop_extraction_flag = True
-            self.reverse_frame = False
-            self.forward_frame = False
-            self.pause_extracting_flag = False
+        with self.condition:
+            self.state = Server.STOPPED
+            self.steps.clear()
+            self.condition.notify_all()
+
+
+    def next_command(self):
+        """
+        Blocks without using any CPU while the session is paused and no
+        move is pending. Returns the state with the (relative, frame) move
+        to make, None while playing or stopped. A paused session leaves
+        the inference scheduler so the other rooms never wait on its frames
+        """
+        with self.condition:
+            if self.state == Server.PAUSED and not self.steps:
+                Server.SCHEDULER.unregister()
+                while self.state == Server.PAUSED and not self.steps:
+                    self.condition.wait()
+                Server.SCHEDULER.register()
+
+            move = self.steps.popleft() if self.state == Server.PAUSED else None
+            return self.state, move
+
+
+    def encode_frame(self, img):
+        """
+        JPEG-encodes an RGB frame straight from the numpy array
+        with the quality chosen for the session
+        """
+        bgr_frame = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        _, buffer = cv2.imencode(".jpg", bgr_frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return buffer.tobytes()
+
+
+    def pictures_folder(self):
+        return Storage.room_folder(os.path.join(os.getcwd(), Server.FOOTAGE_FOLDER), self.room)
 
 
     def convert_to_base64(self, img):
-        img_base64 = Image.fromarray(img)
-        image_bytes = io.BytesIO()
-        img_base64.save(image_bytes, format="jpeg")
-        base64_string = base64.b64encode(image_bytes.getvalue()).decode("utf-8")
+        base64_string = base64.b64encode(self.encode_frame(img)).decode("utf-8")
         return base64_string
 
 
-    def render(self, cap):
-        ret, frame = cap.read()
-        if not ret:
-            return
+    def pack_detections(self, frame_index, pred):
+        """
+        Builds the compact detections payload of a frame, rows are
+        [x1, y1, x2, y2, conf, class]. Binary sessions get a little-endian
+        uint32 frame index and box count followed by the rows as float32
+        """
+        boxes = pred.cpu().numpy().astype(np.float32)
+        if self.binary_frames:
+            return struct.pack("<II", frame_index, len(boxes)) + boxes.tobytes()
+
+        return {
+            "frame":frame_index,
+            "boxes":[[round(value, 2) for value in box] for box in boxes.tolist()]
+        }
 
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        self.current_frame = rgb_frame.copy()
-        results = Server.MODEL(rgb_frame)
-        results.render()
-                
-        self.current_labels = results.pred
 
-        if self.save_picture and (len( self.current_labels[0].tolist())): # the self.current_labels is tensor which has data in format tensor([[x_center y_center width_center height _center]])
-            save_path = os.path.join(os.getcwd(), Server.FOOTAGE_FOLDER,f"{random.randint(1,100)}.jpg")
-            image = Image.fromarray(results.ims[0])
-            image.save(save_path)
+    def skip_stale_frames(self, reader, frame_index, due_index):
+        """
+        Live mode: grabs without decoding the frames the wall clock has
+        already passed, so the next read returns the most recent frame
+        """
+        while frame_index < due_index and reader.position == frame_index and reader.grab():
+            frame_index += 1
+            self.dropped_frames += 1
+            self.metrics.count_dropped()
+        return frame_index
 
-        for img in results.ims:
-            base64_string = self.convert_to_base64(img)
-            self.socket.emit("Processed_Frame", base64_string, room=self.room)
 
-        if self.reverse_frame:
-            self.reverse_frame = False
+    def queue_latest(self, decoded, item):
+        """
+        Live mode: the newest frame replaces the one still waiting for
+        inference, so the model always gets the most recent frame. The
+        decoder is the only producer, the put cannot block
+        """
+        try:
+            decoded.get_nowait()
+            self.dropped_frames += 1
+            self.metrics.count_dropped()
+        except Empty:
+            pass
+        decoded.put_nowait(item)
 
-        if self.forward_frame:
-            self.forward_frame = False
 
+    def decode_frames(self, reader, decoded):
+        """
+        First pipeline stage: reads frames from the video (following the
+        pause/reverse/forward controls) and queues them for inference
+        """
+        try:
+            self.read_frames(reader, decoded)
+        except Exception as error:
+            decoded.put(error)
+        finally:
+            decoded.put(None)
+
+
+    def read_frames(self, reader, decoded):
+        total_frames = reader.frame_count
+        fps = reader.fps or Server.DEFAULT_FPS
+        next_frame_index = 0
+        clock_start = None
+
+        while True:
+            state, move = self.next_command()
+            if state == Server.STOPPED:
+                break
+
+            if state == Server.PAUSED:
+                clock_start = None
+                relative, frame_index = move
+                if relative:
+                    frame_index += self.current_frame_index
+                frame_index = max(0, frame_index)
+                if total_frames:
+                    frame_index = min(total_frames - 1, frame_index)
+            else:
+                frame_index = next_frame_index
+                if self.mode == Server.LIVE_MODE:
+                    if clock_start is None:
+                        clock_start, clock_frame = time.monotonic(), frame_index
+                    elapsed = time.monotonic() - clock_start
+                    due_index = clock_frame + int(elapsed * fps)
+                    if frame_index > due_index:
+                        time.sleep((frame_index - clock_frame) / fps - elapsed)
+                    frame_index = self.skip_stale_frames(reader, frame_index, due_index)
+
+            started = time.perf_counter()
+            frame = reader.read(frame_index)
+            if frame is None:
+                if state == Server.PLAYING:
+                    self.pause() # end of the video, wait for the next command
+                continue
+
+            self.current_frame_index = frame_index
+            next_frame_index = frame_index + 1
+            now = time.perf_counter()
+            self.metrics.observe('decode', now - started)
+            if self.mode == Server.LIVE_MODE:
+                self.queue_latest(decoded, (frame_index, frame, now))
+            else:
+                decoded.put((frame_index, frame, now))
+
+
+    def detect(self, frame_index, rgb_frame):
+        """
+        Returns the Detections of a frame. Frames seen before in this video
+        are served from the detection cache, near-duplicates of the previous
+        frame reuse its boxes and, with a stride, frames between keyframes
+        get tracked boxes. Only the other frames go through the model
+        """
+        boxes = Server.DETECTION_CACHE.get(self.detections_key, frame_index)
+        if boxes is not None:
+            if self.propagator:
+                self.propagator.keyframe(frame_index, rgb_frame, boxes)
+            return self.detected(frame_index, rgb_frame, boxes, 'cache')
+
+        boxes = self.gate.reuse(frame_index, rgb_frame) if self.gate else None
+        if boxes is not None:
+            if self.propagator:
+                self.propagator.hold(frame_index)
+            self.metrics.count_detection('reused')
+            return detections_from_boxes(Server.MODEL, rgb_frame, boxes)
+
+        if self.propagator:
+            # tracked boxes are shown only, the cache and the index keep model outputs
+            boxes = self.propagator.propagate(frame_index, rgb_frame)
+            if boxes is not None:
+                return self.detected(frame_index, rgb_frame, boxes, 'tracked')
+
+        started = time.perf_counter()
+        if self.fov:
+            future = Server.SCHEDULER.submit(self.fov.crop(rgb_frame), self.fov.input_size(InferenceScheduler.INPUT_SIZE))
+        else:
+            future = Server.SCHEDULER.submit(rgb_frame)
+        results = future.result()
+        # results.t holds the pre-process, forward and NMS times (ms) of the whole batch
+        for stage, elapsed in zip(('preprocess', 'forward', 'nms'), results.t):
+            self.metrics.observe(stage, elapsed / 1000)
+        self.metrics.observe('batch_wait', max(0.0, time.perf_counter() - started - sum(results.t) / 1000))
+        boxes = results.pred[0].cpu().numpy()
+        if self.fov:
+            boxes = self.fov.to_frame(boxes)
+        Server.DETECTION_CACHE.put(self.detections_key, frame_index, boxes)
+        self.detections[frame_index] = boxes
+        self.timeline.add(frame_index, boxes)
+        if self.propagator:
+            self.propagator.keyframe(frame_index, rgb_frame, boxes)
+        return self.detected(frame_index, rgb_frame, boxes, 'model')
+
+
+    def detected(self, frame_index, rgb_frame, boxes, source):
+        """
+        Counts where the boxes of a frame came from and makes it the
+        reference of the motion gate
+        """
+        self.metrics.count_detection(source)
+        if self.gate:
+            self.gate.update(frame_index, rgb_frame, boxes)
+        return detections_from_boxes(Server.MODEL, rgb_frame, boxes)
+
+
+    @staticmethod
+    def detections_key_for(video_hash):
+        """
+        Detections are stored per video and per model weights, so
+        retrained weights never reuse the boxes of the previous ones
+        """
+        return f"{video_hash}_{Server.MODEL.weights_hash[:16]}"
+
+
+    @staticmethod
+    def detections_path(video_hash):
+        return os.path.join(Server.DETECTIONS_FOLDER, f"{Server.detections_key_for(video_hash)}.npz")
+
+
+    def load_detections(self):
+        """
+        Takes the video hash from the upload metadata (hashing the file only
+        if it is missing) and warms the detection cache with what previous
+        sessions on the same video have stored on disk
+        """
+        self.video_hash = Storage.read_metadata(self.video_path).get('hash') or Storage.hash_file(self.video_path)
+        self.detections_key = Server.detections_key_for(self.video_hash)
+        self.detections = DetectionCache.load(Server.detections_path(self.video_hash)) if Server.PERSIST_DETECTIONS else {}
+        for frame_index, boxes in self.detections.items():
+            Server.DETECTION_CACHE.put(self.detections_key, frame_index, boxes)
+        self.timeline = DetectionTimeline.for_video(self.detections_key, load=lambda: self.detections)
+
+
+    def save_detections(self):
+        if Server.PERSIST_DETECTIONS and self.detections:
+            DetectionCache.merge(Server.detections_path(self.video_hash), self.detections)
 
-    def extract_frames_and_emit(self):
-        cap = cv2.VideoCapture(self.video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    def infer_frames(self, decoded, inferred):
+        """
+        Second pipeline stage: runs the model on every decoded frame
+        and renders the detections on it
+        """
+        try:
+            self.process_frames(decoded, inferred)
+        except Exception as error:
+            inferred.put(error)
+            self.stop()
+            Server.drain(decoded) # unblocks the decoder until it sees the stop
+        finally:
+            inferred.put(None)
+
+
+    def process_frames(self, decoded, inferred):
         while True:
-            if self.stop_extraction_flag:
+            item = decoded.get()
+            if item is None:
                 break
+            if isinstance(item, Exception): # the decoder failed, handed on to the emitter
+                inferred.put(item)
+                continue
+
+            frame_index, frame, decoded_at = item
+            waited = time.perf_counter() - decoded_at
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            original_frame = rgb_frame.copy()
+            results = self.detect(frame_index, rgb_frame)
+            if self.output == Server.FRAME_OUTPUT or (self.save_picture and len(results.pred[0])):
+                started = time.perf_counter()
+                results.render()
+                self.metrics.observe('render', time.perf_counter() - started)
+            inferred.put((frame_index, original_frame, results, decoded_at, waited, time.perf_counter()))
+
+
+    def emit_frames(self, inferred):
+        """
+        Last pipeline stage: encodes the rendered frames and sends them to the room
+        """
+        while True:
+            item = inferred.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                self.fail(item)
+                continue
+
+            frame_index, original_frame, results, decoded_at, waited, queued = item
+            self.metrics.observe('queue_wait', waited + time.perf_counter() - queued)
+            self.current_frame = original_frame
+            self.displayed_frame_index = frame_index
+            self.current_labels = results.pred
+
+            if self.save_picture and (len( self.current_labels[0].tolist())): # the self.current_labels is tensor which has data in format tensor([[x_center y_center width_center height _center]])
+                self.save_pictures(self.capture.observe(frame_index, results.pred[0].cpu().numpy(), results.ims[0]))
+
+            started = time.perf_counter()
+            if self.output == Server.DETECTIONS_OUTPUT:
+                event, payload = "Detections", self.pack_detections(frame_index, results.pred[0])
+            elif self.binary_frames:
+                event, payload = "Processed_Frame", self.encode_frame(results.ims[0])
+            else:
+                event, payload = "Processed_Frame", self.convert_to_base64(results.ims[0])
+            encoded, sent = time.perf_counter(), time.time()
+            self.socket.emit(event, payload, room=self.room)
+            self.metrics.observe('encode', encoded - started)
+            self.metrics.observe('emit', time.perf_counter() - encoded)
+            self.metrics.count_frame()
+
+            # follows the frame on the same socket, clients pair it with the frame they just got
+            if self.frame_stats or self.mode == Server.LIVE_MODE:
+                stats = {
+                    "frame":frame_index,
+                    "dropped":self.dropped_frames,
+                    "sent":sent, # wall clock, for the delivery latency of the frame
+                    "latency":encoded - decoded_at # seconds from decoding the frame to sending it
+                }
+                self.socket.emit("Frame_Stats", stats, room=self.room)
+
+
+    @staticmethod
+    def drain(queue):
+        while queue.get() is not None:
+            pass
 
-            if self.pause_extracting_flag:
-                if self.reverse_frame:
-                    self.current_frame_index = max(0, self.current_frame_index - 1)
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame_index)
-                    self.render(cap)
-                    continue
-                elif self.forward_frame:
-                    self.current_frame_index = min(total_frames - 1, self.current_frame_index + 1)
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame_index)
-                    self.render(cap)
-                    continue
-                else:
-                    continue
-
-            self.current_frame_index += 1
-            self.render(cap)
-        
-        os.remove(self.video_path)
-        if self.save_picture:
+
+    def fail(self, error):
+        """
+        Stops the session after an error in one of its stages and tells the room
+        """
+        print(f"Session {self.room} failed: {type(error).__name__}: {error}")
+        self.stop()
+        self.socket.emit("Session_Error", {"name":self.room, "error":str(error)}, room=self.room)
+
+
+    def create_propagator(self):
+        if self.detection_stride == Server.ADAPTIVE_STRIDE:
+            return DetectionPropagator(max_stride=Server.MAX_ADAPTIVE_STRIDE, adaptive=True)
+        if self.detection_stride > 1:
+            return DetectionPropagator(max_stride=self.detection_stride)
+        return None
+
+
+    def save_pictures(self, frames):
+        """
+        Hands the frames picked by the capture policy to the writer pool,
+        named after the frame index so they sort in playback order
+        """
+        for frame_index, image in frames:
+            if not Server.FRAME_WRITER.submit(self.pictures_folder(), f"{frame_index:07d}.jpg", image):
+                self.dropped_pictures += 1
+
+
+    def extract_frames_and_emit(self):
+        """
+        Runs the session as a pipeline: a decoder thread and an inference thread
+        feed the encoder/emitter through bounded queues, so decoding of the next
+        frame and encoding of the previous one overlap with inference
+        """
+        reader = None
+        self.dropped_frames = 0
+        self.dropped_pictures = 0
+        self.capture = None
+        Server.SCHEDULER.register()
+        try:
+            reader = VideoReader(self.video_path)
+            self.propagator = self.create_propagator()
+            self.gate = MotionGate(self.motion_threshold, Server.MAX_REUSE) if self.motion_threshold > 0 else None
+            self.load_detections()
+            self.fov = FieldOfView.for_video(self.video_path) if self.crop_field_of_view else None
+            if self.save_picture:
+                os.makedirs(self.pictures_folder(), exist_ok=True)
+                self.capture = CapturePolicy(top_k=Server.CAPTURE_TOP_K,
+                                             keyframe_interval=Server.CAPTURE_KEYFRAME_INTERVAL)
+            # in live mode only the latest frame may wait for inference, newer ones replace it
+            decoded = Queue(maxsize=1 if self.mode == Server.LIVE_MODE else Server.PIPELINE_DEPTH)
+            inferred = Queue(maxsize=Server.PIPELINE_DEPTH)
+
+            stages = [
+                Thread(target=self.decode_frames, args=(reader, decoded), daemon=True),
+                Thread(target=self.infer_frames, args=(decoded, inferred), daemon=True)
+            ]
+            for stage in stages:
+                stage.start()
+
+            try:
+                self.emit_frames(inferred)
+            except Exception as error:
+                self.fail(error)
+                Server.drain(inferred) # unblocks the other stages until they see the stop
+
+            for stage in stages:
+                stage.join()
+        except Exception as error:
+            self.fail(error)
+        finally:
+            Server.SCHEDULER.unregister()
+            self.end_session(reader)
+
+
+    def end_session(self, reader):
+        """
+        Stores what the session computed and releases what it held, also
+        when it failed, then sends "end" with the pictures saved so far
+        """
+        if self.video_hash:
+            self.save_detections()
+        if Storage.release_video(self.video_path) and self.video_hash:
+            DetectionTimeline.evict(self.detections_key)
+        if reader:
+            reader.release()
+
+        if self.save_picture and self.capture:
+            self.save_pictures(self.capture.flush())
+            Server.FRAME_WRITER.wait(self.pictures_folder()) # the ZIP is requested right after "end"
             data = {
                 "name":self.room,
-                "diagnosis":self.diagnosis
+                "diagnosis":self.diagnosis,
+                "dropped":self.dropped_frames,
+                "dropped_pictures":self.dropped_pictures
             }
             self.socket.emit("end", data, room=self.room)
-        cap.release()
 
 
     def start_extraction_thread(self):
-        process = Process(target=self.extract_frames_and_emit())
-        process.start()
+        """
+        Hands the session to the worker pool and returns right away,
+        the Socket.IO handler is no longer blocked for the whole video
+        """
+        self.thread = Server.SESSIONS.submit(self.extract_frames_and_emit)
+        self.thread.add_done_callback(self.session_done)
+
+
+    def session_done(self, future):
+        """
+        Reports the errors which escaped the session, the pool would keep them silently
+        """
+        if not future.cancelled() and future.exception() is not None:
+            self.fail(future.exception())
@@ -1,83 +1,236 @@
 """This class allows server to interact with a storage system
  by performing various operations such as reading from, writing to. """
 
+import io
 import os
-from PIL import Image
+import json
+import uuid
+import shutil
+import hashlib
+import cv2
+from threading import Lock
 import zipfile
-import subprocess
 from werkzeug.utils import secure_filename
+from Class.feedback import FeedbackStore
+
+class ZipSink(io.RawIOBase):
+    """Unseekable file object collecting what zipfile writes, so the
+    archive can be sent while it is being produced"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
 
 class Storage:
 
+    VIDEO_LOCK = Lock() # guards the reference counts of stored videos
+    FEEDBACK_WEIGHT = 10 # times a feedback sample is seen per epoch when retraining
+
     @staticmethod
-    def save_file(folder_dir, file):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(folder_dir, filename)
-        file.save(filepath)
-        return filepath
+    def save_file(folder_dir, file, chunk_size=1024 * 1024):
+        """
+        Streams the uploaded file to a temporary file, hashing it on the way.
+        Returns the temporary path and the sha256 of the content
+        """
+        os.makedirs(folder_dir, exist_ok=True)
+        filepath = os.path.join(folder_dir, f"{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        with open(filepath, 'wb') as output:
+            for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+                output.write(chunk)
+                digest.update(chunk)
+        return filepath, digest.hexdigest()
 
     @staticmethod
-    def clean_system(filename):
-        os.remove(os.path.join(os.getcwd(), filename))
-        bash_code = """rm ./pictures/*"""
-        process = subprocess.Popen(['bash', '-c', bash_code],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, error = process.communicate()
-        
+    def store_video(folder_dir, temp_path, content_hash, filename):
+        """
+        Moves a fully received upload into the content-addressed store as
+        <sha256>.<ext> and takes a reference on it. A video which is already
+        stored is not written again, its metadata is reused as is
+        """
+        extension = secure_filename(filename).rsplit('.', 1)[-1].lower()
+        filepath = os.path.join(folder_dir, f"{content_hash}.{extension}")
+
+        with Storage.VIDEO_LOCK:
+            metadata = Storage.read_metadata(filepath) if os.path.exists(filepath) else {}
+            if metadata:
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, filepath)
+                metadata = Storage.probe_video(filepath, content_hash)
+            metadata["refs"] = metadata.get("refs", 0) + 1
+            Storage.write_metadata(filepath, metadata)
+
+        return filepath, metadata
+
     @staticmethod
-    def download_zip(room, user, folder_dir):
+    def acquire_video(filepath):
+        """
+        Takes one more reference on a stored video, False if it is gone
+        """
+        with Storage.VIDEO_LOCK:
+            metadata = Storage.read_metadata(filepath)
+            if not metadata or not os.path.exists(filepath):
+                return False
+            metadata["refs"] = metadata.get("refs", 0) + 1
+            Storage.write_metadata(filepath, metadata)
+            return True
 
-        pictures_folder = os.path.join(os.getcwd(), folder_dir)
+    @staticmethod
+    def release_video(filepath):
+        """
+        Drops a reference taken by store_video, the video and its
+        metadata are deleted with the last one. Returns True then
+        """
+        with Storage.VIDEO_LOCK:
+            metadata = Storage.read_metadata(filepath)
+            metadata["refs"] = metadata.get("refs", 1) - 1
+            if metadata["refs"] > 0:
+                Storage.write_metadata(filepath, metadata)
+                return False
+            Storage.remove_video(filepath)
+            return True
+
+    @staticmethod
+    def metadata_path(filepath):
+        return f"{filepath}.json"
+
+    @staticmethod
+    def probe_video(filepath, content_hash):
+        """
+        Reads the container metadata once, it is cached next to the
+        video so sessions never reopen the file just to probe it
+        """
+        #pylint: disable=no-member
+        cap = cv2.VideoCapture(filepath)
+        metadata = {
+            "hash":content_hash,
+            "bytes":os.path.getsize(filepath),
+            "width":int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height":int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps":cap.get(cv2.CAP_PROP_FPS),
+            "frame_count":int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        }
+        cap.release()
+        #pylint: enable=no-member
+        return metadata
+
+    @staticmethod
+    def write_metadata(filepath, metadata):
+        temp_path = f"{Storage.metadata_path(filepath)}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(metadata, file)
+        os.replace(temp_path, Storage.metadata_path(filepath))
 
-        # Create a temporary directory to store the zip file
-        temp_dir = os.getcwd()
-        zip_filename = f'{room}_{user.diagnosis}.zip'
-        zip_filepath = os.path.join(temp_dir, zip_filename)
+    @staticmethod
+    def read_metadata(filepath):
+        metadata_path = Storage.metadata_path(filepath)
+        if not os.path.exists(metadata_path):
+            return {}
+        with open(metadata_path, 'r') as file:
+            return json.load(file)
+
+    @staticmethod
+    def cached_metadata(filepath, key, compute):
+        """
+        Returns metadata[key] of a stored video, computing it once with
+        compute() and keeping it in the metadata file. Videos outside the
+        store (no metadata file) get it computed every time
+        """
+        metadata = Storage.read_metadata(filepath)
+        if key in metadata:
+            return metadata[key]
+
+        value = compute()
+        with Storage.VIDEO_LOCK:
+            metadata = Storage.read_metadata(filepath)
+            if os.path.exists(filepath) and metadata:
+                metadata[key] = value
+                Storage.write_metadata(filepath, metadata)
+        return value
+
+    @staticmethod
+    def remove_video(filepath):
+        for path in (filepath, Storage.metadata_path(filepath)):
+            if os.path.exists(path):
+                os.remove(path)
 
-        # Create a zip file and add all images from the pictures folder
-        with zipfile.ZipFile(zip_filepath, 'w') as zip_file:
+    @staticmethod
+    def hash_file(filepath, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def room_folder(folder_dir, room):
+        return os.path.join(folder_dir, secure_filename(room))
+
+    @staticmethod
+    def clean_room(room, *folders):
+        """
+        Removes the folders of one room only (pictures, partial uploads),
+        the other rooms on the node are left alone
+        """
+        if not secure_filename(room):
+            return
+        for folder_dir in folders:
+            shutil.rmtree(Storage.room_folder(folder_dir, room), ignore_errors=True)
+
+    @staticmethod
+    def clean_system(filename):
+        # archives are streamed now, only older versions left them on disk
+        zip_filepath = os.path.join(os.getcwd(), secure_filename(filename))
+        if os.path.exists(zip_filepath):
+            os.remove(zip_filepath)
+        
+    @staticmethod
+    def download_zip(room, folder_dir):
+        """
+        Generates the ZIP of the room's pictures chunk by chunk, nothing is
+        written to disk. The JPEGs are already compressed so they are stored
+        as is, and the first bytes go out before the last file is read
+        """
+        pictures_folder = Storage.room_folder(os.path.join(os.getcwd(), folder_dir), room)
+        sink = ZipSink()
+
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zip_file:
             for root, dirs, files in os.walk(pictures_folder):
-                for file in files:
+                for file in sorted(files):
+                    if file.endswith('.tmp'): # still being written
+                        continue
                     file_path = os.path.join(root, file)
                     arcname = os.path.relpath(file_path, pictures_folder)
                     zip_file.write(file_path, arcname=arcname)
-        
-        return zip_filepath
+                    yield sink.pop()
+
+        yield sink.pop()
    
     @staticmethod
-    def feedback(data, sizes, feedback_folder, current_frame, current_labels):
-          
+    def feedback(data, sizes, feedback_folder, current_frame, current_labels, source=None):
+        """
+        Converts the model boxes and the boxes corrected by the user to YOLO
+        labels and stores the frame as one feedback sample
+        """
         boxes = data.get('boxes')
         size = data.get('size')
         windowSize = data.get('windowSize')
+        label_lines = []
 
-        count = int()
-        label_path = str()
-        count_file = os.path.join(feedback_folder, 'count_frames.txt')
-
-        if not os.path.exists(feedback_folder):
-            os.makedirs(feedback_folder)
-            os.makedirs(os.path.join(feedback_folder, 'images'))
-            os.makedirs(os.path.join(feedback_folder, 'labels'))
-        
-
-            with open(count_file, 'w') as file:
-                count += 1
-                file.write(str(count))
-                file.close()
-
-        else:
-            with open(count_file, 'r') as file:
-                count = int(file.read())
-                count += 1
-                file.close()
-
-
-        rgb_image = Image.fromarray(current_frame)
-        footage_name = os.path.join(feedback_folder, 'images', f"{count}.jpg")
-        rgb_image.save(footage_name)
-
-        
         for box in current_labels:
             box = box.tolist()
             print(box)
@@ -88,13 +241,7 @@ class Storage:
                 center_height =  round((box[i][3] - box[i][1]) / sizes["height"], 6)
                 label = int(box[i][5])
 
-                labelling_data = f"{label} {center_x} {center_y} {center_width} {center_height}"
-                
-                label_path = os.path.join(feedback_folder, 'labels', f"{count}.txt")
-
-                with open(label_path, 'a+') as file:
-                    file.write(labelling_data + '\n')
-
+                label_lines.append(f"{label} {center_x} {center_y} {center_width} {center_height}")
 
 
         for i, box in enumerate(boxes):
@@ -112,20 +259,8 @@ class Storage:
             else:
                 label = 0
 
-            labelling_data = f"{label} {center_x} {center_y} {center_width} {center_height}"
-
-            label_path = os.path.join(feedback_folder, 'labels', f"{count}.txt")
+            label_lines.append(f"{label} {center_x} {center_y} {center_width} {center_height}")
 
-            with open(label_path, 'a+') as file:
-                file.write(labelling_data + '\n')
-        
-        for _ in range(9):
-            count += 1
-            replicated_footage = os.path.join(feedback_folder, 'images', f"{count}.jpg")
-            replicated_label_path = os.path.join(feedback_folder, 'labels', f"{count}.txt")
-            os.system(f'cp "{footage_name}" "{replicated_footage}"')
-            os.system(f'cp "{label_path}" "{replicated_label_path}"')
-
-        with open(count_file, 'w') as file:
-            file.write(str(count))
-            file.close()
\ No newline at end of file
+        # the sample is stored once, retraining oversamples it from its manifest weight
+        store = FeedbackStore.open(feedback_folder)
+        return store.add(current_frame, label_lines, Storage.FEEDBACK_WEIGHT, source or {})
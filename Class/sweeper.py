@@ -0,0 +1,122 @@
+"""This class cleans the storage of the node in the background. Rooms keep
+ their pictures and partial uploads in their own folders, which are removed
+ once the room is gone and their TTL expired. Stored videos nobody uses
+ any more are removed too, and the oldest leftovers are evicted first
+ whenever the folders grow past the disk usage cap. """
+
+import os
+import time
+import shutil
+from threading import Event, Thread
+from werkzeug.utils import secure_filename
+from Class.storage import Storage
+
+class StorageSweeper:
+
+    INTERVAL = 60 # seconds between two sweeps
+    PICTURES_TTL = 60 * 60 # pictures of rooms which are gone
+    UPLOAD_TTL = 24 * 60 * 60 # partial uploads and stored videos left unused
+    DISK_CAP = 20 * 1024 ** 3 # bytes of uploads and pictures kept on the node
+
+    def __init__(self, upload_folder, footage_folder, active_rooms, active_videos):
+        self.upload_folder = upload_folder
+        self.footage_folder = footage_folder
+        self.active_rooms = active_rooms
+        self.active_videos = active_videos
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def run(self):
+        while not self.stopped.wait(StorageSweeper.INTERVAL):
+            try:
+                self.sweep()
+            except OSError as error:
+                print(f"Storage sweep failed: {error}")
+
+
+    @staticmethod
+    def folder_size(folder):
+        size = 0
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return size
+
+
+    @staticmethod
+    def remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with Storage.VIDEO_LOCK:
+                Storage.remove_video(path)
+
+
+    def sweep(self):
+        """
+        Removes everything whose TTL expired, then evicts the oldest of
+        what is left (never what an active room or video uses) until the
+        folders fit in the disk usage cap
+        """
+        now = time.time()
+        rooms = {secure_filename(room) for room in self.active_rooms()}
+        videos = {os.path.abspath(video) for video in self.active_videos() if video}
+        candidates = [] # (last modified, size, path) evictable over the cap
+
+        if os.path.isdir(self.footage_folder):
+            for entry in os.scandir(self.footage_folder):
+                if not entry.is_dir() or entry.name in rooms:
+                    continue
+                if now - entry.stat().st_mtime > StorageSweeper.PICTURES_TTL:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    candidates.append((entry.stat().st_mtime, StorageSweeper.folder_size(entry.path), entry.path))
+
+        if os.path.isdir(self.upload_folder):
+            for entry in os.scandir(self.upload_folder):
+                if entry.is_dir():
+                    self.sweep_room_uploads(entry, entry.name in rooms, now)
+                elif not entry.name.endswith('.json') and os.path.abspath(entry.path) not in videos:
+                    self.sweep_video(entry, now, candidates)
+
+        total = StorageSweeper.folder_size(self.upload_folder) + StorageSweeper.folder_size(self.footage_folder)
+        for _, size, path in sorted(candidates):
+            if total <= StorageSweeper.DISK_CAP:
+                break
+            StorageSweeper.remove(path)
+            total -= size
+
+
+    def sweep_room_uploads(self, room_entry, active, now):
+        for entry in os.scandir(room_entry.path):
+            if now - entry.stat().st_mtime > StorageSweeper.UPLOAD_TTL:
+                os.remove(entry.path)
+        if not active and not os.listdir(room_entry.path):
+            os.rmdir(room_entry.path)
+
+
+    def sweep_video(self, entry, now, candidates):
+        """
+        A stored video is released by its sessions and jobs, one which
+        still holds references past the TTL was leaked by a session that
+        never ran. Its metadata file is touched on every reference change
+        """
+        metadata_path = Storage.metadata_path(entry.path)
+        last_used = os.path.getmtime(metadata_path) if os.path.exists(metadata_path) else entry.stat().st_mtime
+        if now - last_used > StorageSweeper.UPLOAD_TTL:
+            with Storage.VIDEO_LOCK:
+                Storage.remove_video(entry.path)
+        elif now - last_used > StorageSweeper.PICTURES_TTL: # idle for a while, evictable over the cap
+            candidates.append((last_used, entry.stat().st_size, entry.path))
@@ -0,0 +1,129 @@
+"""This class merges per-frame detections into intervals per class
+ (start/end frame, peak confidence and best frame), so clinicians can
+ jump straight to where polyps appear. It is updated incrementally as
+ sessions and analysis jobs process frames, in any order. """
+
+from bisect import bisect_right
+from threading import Lock
+
+class DetectionTimeline:
+
+    MAX_GAP = 15 # frames without detection still counted inside an interval
+    timelines = {}
+    registry_lock = Lock()
+
+    def __init__(self):
+        self.intervals = {} # class -> sorted list of [start, end, peak_conf, best_frame]
+        self.lock = Lock()
+
+
+    @classmethod
+    def for_video(cls, detections_key, load=None):
+        """
+        Returns the timeline of a video, building it the first time
+        from the detections returned by load() when given. It stays
+        registered until evict() is called
+        """
+        with cls.registry_lock:
+            timeline = cls.timelines.get(detections_key)
+            if timeline is None:
+                timeline = cls.from_detections(load() if load else {})
+                cls.timelines[detections_key] = timeline
+            return timeline
+
+
+    @classmethod
+    def get(cls, detections_key):
+        """
+        Returns the registered timeline of a video, None if no session or
+        job is working on it
+        """
+        with cls.registry_lock:
+            return cls.timelines.get(detections_key)
+
+
+    @classmethod
+    def evict(cls, detections_key):
+        """
+        Forgets the timeline of a video, called when its last reference
+        is released
+        """
+        with cls.registry_lock:
+            cls.timelines.pop(detections_key, None)
+
+
+    @classmethod
+    def from_detections(cls, detections):
+        """
+        Builds an unregistered timeline from frame_index -> boxes
+        """
+        timeline = cls()
+        for frame_index, boxes in detections.items():
+            timeline.add(frame_index, boxes)
+        return timeline
+
+
+    def add(self, frame_index, boxes):
+        """
+        Adds the (n, 6) [x1, y1, x2, y2, conf, class] boxes of a frame
+        """
+        best = {}
+        for *_, conf, label in boxes.tolist():
+            best[int(label)] = max(conf, best.get(int(label), 0.0))
+
+        with self.lock:
+            for label, conf in best.items():
+                self.insert(self.intervals.setdefault(label, []), frame_index, conf)
+
+
+    def insert(self, intervals, frame_index, conf):
+        position = bisect_right([interval[0] for interval in intervals], frame_index)
+
+        previous = intervals[position - 1] if position > 0 else None
+        following = intervals[position] if position < len(intervals) else None
+        joins_previous = previous is not None and frame_index <= previous[1] + DetectionTimeline.MAX_GAP
+        joins_following = following is not None and following[0] - DetectionTimeline.MAX_GAP <= frame_index
+
+        if joins_previous:
+            interval = previous
+        elif joins_following:
+            interval = following
+        else:
+            intervals.insert(position, [frame_index, frame_index, conf, frame_index])
+            return
+
+        interval[0] = min(interval[0], frame_index)
+        interval[1] = max(interval[1], frame_index)
+        if conf > interval[2]:
+            interval[2], interval[3] = conf, frame_index
+
+        if joins_previous and joins_following: # the frame bridges two intervals
+            previous[1] = max(previous[1], following[1])
+            if following[2] > previous[2]:
+                previous[2], previous[3] = following[2], following[3]
+            del intervals[position]
+
+
+    def to_dict(self, names):
+        """
+        Returns the intervals keyed by class name, names maps class ids to names
+        """
+        with self.lock:
+            return {
+                names.get(label, str(label)): [
+                    {
+                        "start":start,
+                        "end":end,
+                        "peak_conf":round(peak_conf, 4),
+                        "best_frame":best_frame
+                    }
+                    for start, end, peak_conf, best_frame in intervals
+                ]
+                for label, intervals in sorted(self.intervals.items())
+            }
+
+
+    def interval(self, label, position):
+        with self.lock:
+            intervals = self.intervals.get(label, [])
+            return intervals[position] if 0 <= position < len(intervals) else None
@@ -0,0 +1,128 @@
+"""This class receives a video in chunks, streaming each chunk straight to
+ disk and hashing the content as it arrives, so large procedure videos
+ never sit in memory and an interrupted upload resumes where it stopped. """
+
+import os
+import glob
+import json
+import uuid
+import hashlib
+from threading import Lock
+from werkzeug.utils import secure_filename
+
+class ChunkedUpload:
+
+    CHUNK_SIZE = 1024 * 1024
+    uploads = {}
+    lock = Lock()
+
+    def __init__(self, upload_id, folder, filename, room, received=0):
+        self.upload_id = upload_id
+        self.folder = folder
+        self.filename = secure_filename(filename)
+        self.room = room
+        self.received = received
+        self.digest = None
+        self.lock = Lock()
+
+
+    @property
+    def part_path(self):
+        return os.path.join(self.folder, f"{self.upload_id}.part")
+
+
+    @property
+    def state_path(self):
+        return os.path.join(self.folder, f"{self.upload_id}.upload.json")
+
+
+    @classmethod
+    def create(cls, folder, filename, room):
+        os.makedirs(folder, exist_ok=True)
+        upload = cls(uuid.uuid4().hex, folder, filename, room)
+        open(upload.part_path, 'wb').close()
+        upload.save_state()
+        with cls.lock:
+            cls.uploads[upload.upload_id] = upload
+        return upload
+
+
+    @classmethod
+    def get(cls, folder, upload_id):
+        """
+        Returns the upload in progress, restoring it from its state file in
+        the room folders if the server restarted in the middle of it.
+        None if unknown
+        """
+        with cls.lock:
+            upload = cls.uploads.get(upload_id)
+            if upload is not None:
+                return upload
+
+            state_paths = glob.glob(os.path.join(folder, '*', f"{secure_filename(upload_id)}.upload.json"))
+            if not state_paths:
+                return None
+
+            with open(state_paths[0], 'r') as file:
+                state = json.load(file)
+            upload = cls(state['upload_id'], os.path.dirname(state_paths[0]), state['filename'], state['room'])
+            upload.received = os.path.getsize(upload.part_path)
+            cls.uploads[upload_id] = upload
+            return upload
+
+
+    def save_state(self):
+        state = {
+            "upload_id":self.upload_id,
+            "filename":self.filename,
+            "room":self.room
+        }
+        with open(self.state_path, 'w') as file:
+            json.dump(state, file)
+
+
+    def resume_digest(self):
+        """
+        The running hash is lost with the process, rebuild it
+        from the bytes already on disk before appending more
+        """
+        self.digest = hashlib.sha256()
+        with open(self.part_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(ChunkedUpload.CHUNK_SIZE), b''):
+                self.digest.update(chunk)
+
+
+    def write(self, offset, stream):
+        """
+        Appends the chunk read from stream at offset, which must be the
+        number of bytes received so far. Returns the new offset, or None
+        if the offset does not match (the client should resume from
+        self.received)
+        """
+        with self.lock:
+            if offset != self.received:
+                return None
+            if self.digest is None:
+                self.resume_digest()
+
+            with open(self.part_path, 'ab') as file:
+                for chunk in iter(lambda: stream.read(ChunkedUpload.CHUNK_SIZE), b''):
+                    file.write(chunk)
+                    self.digest.update(chunk)
+                    self.received += len(chunk)
+            return self.received
+
+
+    def finalize(self):
+        """
+        Returns the path of the complete file with its content hash,
+        the upload is forgotten afterwards
+        """
+        with self.lock:
+            if self.digest is None:
+                self.resume_digest()
+            os.remove(self.state_path)
+
+        with ChunkedUpload.lock:
+            ChunkedUpload.uploads.pop(self.upload_id, None)
+        return self.part_path, self.digest.hexdigest()
@@ -0,0 +1,140 @@
+"""This class reads the frames of a session video. It keeps the recently
+ decoded frames in a ring buffer bounded in bytes and indexes the
+ keyframes of the video, so stepping back and forth does not re-decode
+ long GOPs every time. The keyframe index is built on the first seek and
+ kept in the video metadata. """
+
+import shutil
+import subprocess
+from bisect import bisect_right
+from collections import OrderedDict
+import cv2
+from Class.storage import Storage
+
+class VideoReader:
+
+    BUFFER_SIZE = 30 # decoded frames kept per session at most
+    BUFFER_BYTES = 64 * 1024 * 1024 # decoded frames kept per session, in bytes
+
+    def __init__(self, video_path, buffer_size=BUFFER_SIZE, buffer_bytes=BUFFER_BYTES):
+        self.video_path = video_path
+        self.cap = cv2.VideoCapture(video_path)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.position = 0 # index of the frame the next cap.read() returns
+        self.buffer = OrderedDict()
+        self.buffer_bytes = buffer_bytes
+        self.size = 0
+        frame_bytes = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * 3
+        self.buffer_size = max(1, min(buffer_size, buffer_bytes // frame_bytes)) if frame_bytes else buffer_size
+        self.keyframes = None
+
+
+    def keyframe_index(self):
+        if self.keyframes is None:
+            self.keyframes = Storage.cached_metadata(self.video_path, 'keyframes',
+                                                     lambda: VideoReader.index_keyframes(self.video_path, self.fps))
+        return self.keyframes
+
+
+    @staticmethod
+    def index_keyframes(video_path, fps):
+        """
+        Lists the frame indices of the keyframes from the container packets,
+        without decoding anything. The list is empty when ffprobe is not
+        installed, the reader then falls back to OpenCV seeking
+        """
+        if not fps or shutil.which('ffprobe') is None:
+            return []
+
+        command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                   '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path]
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            return []
+
+        timestamps = []
+        for line in process.stdout.splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                timestamps.append(float(pts_time))
+
+        if not timestamps:
+            return []
+
+        origin = min(timestamps)
+        return sorted({round((timestamp - origin) * fps) for timestamp in timestamps})
+
+
+    def store(self, index, frame):
+        if index in self.buffer:
+            self.size -= self.buffer.pop(index).nbytes
+        self.buffer[index] = frame
+        self.size += frame.nbytes
+        while len(self.buffer) > 1 and (len(self.buffer) > self.buffer_size or self.size > self.buffer_bytes):
+            self.size -= self.buffer.popitem(last=False)[1].nbytes
+
+
+    def seek(self, index):
+        """
+        Positions the capture on the frame at index. Decoding starts from the
+        nearest keyframe and the frames leading up to index are buffered, so
+        the following reverse steps are served from memory
+        """
+        keyframes = self.keyframe_index()
+        keyframe = bisect_right(keyframes, index) - 1
+        if keyframe >= 0:
+            start = keyframes[keyframe]
+        else:
+            start = max(0, index - self.buffer_size + 1)
+
+        if not start <= self.position <= index:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            self.position = start
+
+        while self.position < index:
+            if index - self.position < self.buffer_size:
+                ret, frame = self.cap.read()
+                if ret:
+                    self.store(self.position, frame)
+            else:
+                ret = self.cap.grab()
+            if not ret:
+                break
+            self.position += 1
+
+
+    def read(self, index):
+        """
+        Returns the BGR frame at index, or None past the end of the video
+        """
+        if index in self.buffer:
+            self.buffer.move_to_end(index)
+            return self.buffer[index]
+
+        if index != self.position:
+            self.seek(index)
+
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+
+        self.position = index + 1
+        self.store(index, frame)
+        return frame
+
+
+    def grab(self):
+        """
+        Skips the next frame without decoding it
+        """
+        ret = self.cap.grab()
+        if ret:
+            self.position += 1
+        return ret
+
+
+    def release(self):
+        self.buffer.clear()
+        self.size = 0
+        self.cap.release()
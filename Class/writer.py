@@ -0,0 +1,81 @@
+"""This class saves the frames with detections in the background. Sessions
+ hand over the rendered frame and go on, a small pool of writer threads
+ encodes it to JPEG and writes it to a temporary file renamed in place,
+ so the ZIP of the pictures never sees a half written file. """
+
+import os
+from queue import Queue, Full
+from threading import Condition, Thread
+import cv2
+
+class FrameWriter:
+
+    DROP = 'drop' # a full queue skips the picture, playback never waits
+    BLOCK = 'block' # a full queue holds the session until a writer is free
+    JPEG_QUALITY = 90
+
+    def __init__(self, workers=2, max_queued=64, policy=DROP):
+        self.queue = Queue(maxsize=max_queued)
+        self.policy = policy
+        self.pending = {} # folder -> pictures queued or being written
+        self.dropped = 0
+        self.condition = Condition()
+        self.threads = [Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, folder, name, image):
+        """
+        Queues an RGB frame to be saved as folder/name. Returns False
+        if it was dropped because the queue is full
+        """
+        with self.condition:
+            self.pending[folder] = self.pending.get(folder, 0) + 1
+        try:
+            self.queue.put((folder, name, image), block=self.policy == FrameWriter.BLOCK)
+            return True
+        except Full:
+            with self.condition:
+                self.dropped += 1
+            self.done(folder)
+            return False
+
+
+    def done(self, folder):
+        with self.condition:
+            self.pending[folder] -= 1
+            if not self.pending[folder]:
+                del self.pending[folder]
+                self.condition.notify_all()
+
+
+    def wait(self, folder):
+        """
+        Blocks until every picture queued for the folder is on disk
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: folder not in self.pending)
+
+
+    def run(self):
+        while True:
+            folder, name, image = self.queue.get()
+            try:
+                self.write(os.path.join(folder, name), image)
+            except (OSError, cv2.error) as error:
+                print(f"Saving {name} failed: {error}")
+            finally:
+                self.done(folder)
+
+
+    @staticmethod
+    def write(path, image):
+        ret, buffer = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                                   [int(cv2.IMWRITE_JPEG_QUALITY), FrameWriter.JPEG_QUALITY])
+        if not ret:
+            raise OSError(f"could not encode {path}")
+
+        with open(f"{path}.tmp", 'wb') as file:
+            file.write(buffer.tobytes())
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,320 @@
+""" This is the load test of the Socket.IO pipeline. It generates synthetic
+    endoscopy-like videos, then runs one headless client per room through
+    join -> /send-videos -> start-session against a running main.py and
+    writes per-room FPS, per-frame latency (decode to arrival) and live
+    lag percentiles and the CPU and memory of the server to a JSON report.
+    Everything runs offline, the latency assumes the client and server
+    clocks agree (same host).
+
+    python loadtest.py --launch --rooms 8 --duration 30 --report report.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import psutil
+import requests
+import socketio
+
+VIDEO_FOLDER = './loadtest'
+
+
+def generate_video(path, seed, width=640, height=480, fps=30, seconds=20):
+    """Writes a synthetic colonoscopy-like clip: moving mucosa texture with
+    vessels and specular highlights, polyp-like bulges passing through the
+    field of view, and the circular mask of the endoscope"""
+    rng = np.random.default_rng(seed)
+    texture_size = (height * 2, width * 2)
+    noise = cv2.GaussianBlur(rng.random(texture_size).astype(np.float32), (0, 0), 12)
+    noise = (noise - noise.min()) / (noise.max() - noise.min())
+    texture = np.dstack([90 + 50 * noise, 80 + 40 * noise, 170 + 60 * noise]).astype(np.uint8) # BGR
+    for _ in range(40): # vessels
+        points = np.cumsum(rng.normal(0, 12, (30, 2)), axis=0) + rng.random(2) * texture_size[::-1]
+        cv2.polylines(texture, [points.astype(np.int32)], False, (60, 40, 140), int(rng.integers(1, 4)))
+    texture = cv2.GaussianBlur(texture, (5, 5), 0)
+
+    mask = np.zeros((height, width), np.uint8)
+    cv2.circle(mask, (width // 2, height // 2), int(min(width, height) * 0.55), 255, -1)
+    polyps = [(rng.integers(0, seconds * fps), rng.integers(2 * fps, 5 * fps), rng.random(2), rng.integers(25, 70))
+              for _ in range(max(1, seconds // 4))]
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for frame_index in range(seconds * fps):
+        t = frame_index / fps
+        x = int((width / 2) * (1 + np.sin(t * 0.7 + seed)))
+        y = int((height / 2) * (1 + np.cos(t * 0.5 + seed)))
+        frame = texture[y:y + height, x:x + width].copy()
+
+        for start, length, position, radius in polyps:
+            if start <= frame_index < start + length:
+                progress = (frame_index - start) / length
+                center = (int(position[0] * width * 0.6 + width * 0.2 + progress * 60),
+                          int(position[1] * height * 0.6 + height * 0.2))
+                cv2.ellipse(frame, center, (int(radius), int(radius * 0.8)), 0, 0, 360, (70, 90, 190), -1)
+                cv2.ellipse(frame, (center[0] - int(radius) // 3, center[1] - int(radius) // 3),
+                            (int(radius) // 3, int(radius) // 4), 0, 0, 360, (150, 170, 235), -1)
+
+        for _ in range(3): # specular highlights
+            cv2.circle(frame, (int(rng.integers(0, width)), int(rng.integers(0, height))),
+                       int(rng.integers(2, 6)), (250, 250, 250), -1)
+        frame = cv2.GaussianBlur(frame, (3, 3), 0)
+        writer.write(cv2.bitwise_and(frame, frame, mask=mask))
+    writer.release()
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {"p50":round(pick(50), 2), "p90":round(pick(90), 2), "p99":round(pick(99), 2), "max":round(values[-1], 2)}
+
+
+def stage_means(metrics_text, room):
+    """Mean ms per frame of every pipeline stage of the room, from /metrics"""
+    label = room.replace('\\', '\\\\').replace('"', '\\"')
+    totals = {}
+    for kind, stage, value in re.findall(r'gastrogenius_stage_seconds_(sum|count)\{room="%s",stage="(\w+)"\} (\S+)'
+                                         % re.escape(label), metrics_text):
+        totals.setdefault(stage, {})[kind] = float(value)
+    return {stage: round(1000 * total['sum'] / total['count'], 2)
+            for stage, total in totals.items() if total.get('count')}
+
+
+class RoomClient:
+
+    def __init__(self, url, room, video_path, args):
+        self.url = url
+        self.room = room
+        self.video_path = video_path
+        self.args = args
+        self.frame_count = int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = args.fps
+        self.arrivals = []
+        self.last_arrival = None # wall clock of the last frame, paired with the Frame_Stats following it
+        self.latencies = []
+        self.lags = []
+        self.received_bytes = 0
+        self.started = None
+        self.done = Event()
+        self.error = None
+        self.stages = {}
+
+
+    def on_frame(self, payload):
+        self.arrivals.append(time.perf_counter())
+        self.last_arrival = time.time()
+        self.received_bytes += len(payload)
+        if len(self.arrivals) >= self.frame_count:
+            self.done.set()
+
+
+    def on_stats(self, stats):
+        # every mode: from the server decoding the frame to it being received
+        if self.last_arrival is not None:
+            self.latencies.append(1000 * (stats['latency'] + self.last_arrival - stats['sent']))
+        # live mode: how far behind the wall clock of the video the frame arrived
+        if self.args.mode == 'live':
+            self.lags.append(1000 * (time.perf_counter() - self.started - stats['frame'] / self.fps))
+        if stats['frame'] >= self.frame_count - 1:
+            self.done.set()
+
+
+    def run(self):
+        client = socketio.Client(reconnection=False)
+        client.on('Processed_Frame', self.on_frame)
+        client.on('Detections', lambda payload: self.on_frame(payload if isinstance(payload, bytes) else json.dumps(payload)))
+        client.on('Frame_Stats', self.on_stats)
+        try:
+            client.connect(self.url, wait_timeout=30)
+            client.call('join', {"name":self.room, "binary":self.args.binary, "stats":True}, timeout=30)
+
+            with open(self.video_path, 'rb') as file:
+                response = requests.post(f"{self.url}/send-videos", data={"name":self.room},
+                                         files={"file":(os.path.basename(self.video_path), file, 'video/mp4')}, timeout=300)
+            response.raise_for_status()
+
+            session = {
+                "name":self.room,
+                "diagnosis":"loadtest",
+                "save_value":self.args.save_pictures,
+                "video_path":response.json()['filepath'],
+                "mode":self.args.mode,
+                "output":self.args.output
+            }
+            self.started = time.perf_counter()
+            client.call('start-session', session, timeout=30)
+            self.done.wait(self.args.duration)
+
+            client.call('stop_thread', self.room, timeout=30)
+            self.stages = stage_means(requests.get(f"{self.url}/metrics", timeout=30).text, self.room)
+            client.call('leave', self.room, timeout=30)
+        except Exception as error:
+            self.error = f"{type(error).__name__}: {error}"
+        finally:
+            client.disconnect()
+
+
+    def report(self):
+        arrivals = self.arrivals
+        elapsed = arrivals[-1] - arrivals[0] if len(arrivals) > 1 else 0
+        return {
+            "room":self.room,
+            "frames":len(arrivals),
+            "fps":round((len(arrivals) - 1) / elapsed, 2) if elapsed else 0.0,
+            "first_frame_ms":round(1000 * (arrivals[0] - self.started), 2) if arrivals else None,
+            "frame_interval_ms":percentiles([1000 * (b - a) for a, b in zip(arrivals, arrivals[1:])]),
+            "latency_ms":percentiles(self.latencies),
+            "lag_ms":percentiles(self.lags),
+            "received_mb":round(self.received_bytes / 1024 ** 2, 2),
+            "stage_ms":self.stages,
+            "error":self.error
+        }
+
+
+class ResourceSampler:
+
+    def __init__(self, pid, interval=0.5):
+        self.process = psutil.Process(pid) if pid else None
+        self.interval = interval
+        self.cpu = []
+        self.rss = []
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+
+    def run(self):
+        self.process.cpu_percent()
+        while not self.stopped.wait(self.interval):
+            try:
+                processes = [self.process] + self.process.children(recursive=True)
+                self.cpu.append(sum(process.cpu_percent() for process in processes))
+                self.rss.append(sum(process.memory_info().rss for process in processes) / 1024 ** 2)
+            except psutil.Error:
+                break
+
+
+    def start(self):
+        if self.process:
+            self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if not self.cpu:
+            return None
+        return {
+            "cpu_percent":{"mean":round(sum(self.cpu) / len(self.cpu), 1), "max":round(max(self.cpu), 1)},
+            "rss_mb":{"mean":round(sum(self.rss) / len(self.rss), 1), "max":round(max(self.rss), 1)},
+            "cpu_count":psutil.cpu_count()
+        }
+
+
+def launch_server(url, timeout=600):
+    """Starts main.py next to this file and waits until it answers, the
+    model is loaded at import time so this can take a while"""
+    process = subprocess.Popen([sys.executable, 'main.py'], cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"main.py exited with code {process.returncode}")
+        try:
+            requests.get(f"{url}/metrics", timeout=2)
+            return process
+        except requests.ConnectionError:
+            time.sleep(1)
+    process.terminate()
+    raise RuntimeError("main.py did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--launch', action='store_true', help='start main.py and stop it at the end')
+    parser.add_argument('--server-pid', type=int, help='pid of an already running server to sample')
+    parser.add_argument('--rooms', type=int, default=4, help='concurrent rooms')
+    parser.add_argument('--duration', type=float, default=30, help='seconds each room plays at most')
+    parser.add_argument('--mode', default='review', choices=['review', 'live'])
+    parser.add_argument('--output', default='frames', choices=['frames', 'detections'])
+    parser.add_argument('--binary', action='store_true', help='binary JPEG frames instead of base64')
+    parser.add_argument('--save-pictures', action='store_true')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--seconds', type=int, default=20, help='length of the generated videos')
+    parser.add_argument('--seed', type=int, help='fixed seed, reruns then reuse the videos and the'
+                                                  ' detections the server stored for them')
+    parser.add_argument('--report', default='loadtest_report.json')
+    parser.add_argument('--fail-below', type=float, help='exit with 1 if the mean room FPS is lower')
+    args = parser.parse_args()
+
+    # every room gets its own content, otherwise deduplication and the
+    # detection cache would serve all rooms but the first without inference
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 31)
+    os.makedirs(VIDEO_FOLDER, exist_ok=True)
+    video_paths = [os.path.join(VIDEO_FOLDER, f"synthetic_{seed + room}_{args.width}x{args.height}_{args.seconds}s.mp4")
+                   for room in range(args.rooms)]
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(lambda room: os.path.exists(video_paths[room]) or generate_video(
+            video_paths[room], seed + room, args.width, args.height, args.fps, args.seconds), range(args.rooms)))
+
+    server = launch_server(args.url) if args.launch else None
+    sampler = ResourceSampler(server.pid if server else args.server_pid)
+    clients = [RoomClient(args.url, f"loadtest-{seed}-{room}", video_paths[room], args) for room in range(args.rooms)]
+
+    try:
+        sampler.start()
+        started = time.time()
+        threads = [Thread(target=client.run) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        resources = sampler.stop()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    rooms = [client.report() for client in clients]
+    room_fps = [room['fps'] for room in rooms]
+    report = {
+        "config":{**vars(args), "seed":seed},
+        "started":started,
+        "rooms":rooms,
+        "aggregate":{
+            "rooms":len(rooms),
+            "failed_rooms":sum(1 for room in rooms if room['error']),
+            "total_fps":round(sum(room_fps), 2),
+            "mean_fps":round(sum(room_fps) / len(room_fps), 2) if room_fps else 0.0,
+            "min_fps":min(room_fps) if room_fps else 0.0,
+            "frame_interval_ms":percentiles([1000 * (b - a) for client in clients
+                                             for a, b in zip(client.arrivals, client.arrivals[1:])]),
+            "latency_ms":percentiles([latency for client in clients for latency in client.latencies]),
+            "lag_ms":percentiles([lag for client in clients for lag in client.lags])
+        },
+        "server":resources
+    }
+
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    aggregate = report['aggregate']
+    print(f"{aggregate['rooms']} rooms ({aggregate['failed_rooms']} failed): {aggregate['total_fps']} FPS in total, "
+          f"{aggregate['mean_fps']} per room (min {aggregate['min_fps']}), report in {args.report}")
+    if args.fail_below is not None and aggregate['mean_fps'] < args.fail_below:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
 """ This is the flask application which 
     runs the ai model for Polyps Detection"""
 import os
-import cv2
-from flask import Flask, request, jsonify, send_file
+import re
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room, leave_room
 from Class.server import Server
 from Class.storage import Storage
+from Class.sweeper import StorageSweeper
+from Class.metrics import SessionMetrics
+from Class.upload import ChunkedUpload
+from Class.jobs import AnalysisJob
+from Class.cache import DetectionCache
+from Class.timeline import DetectionTimeline
+from segmentation import STARTUP_TIMINGS
 
 users = {}
 app = Flask(__name__, static_folder = './build', static_url_path = '/')
@@ -35,6 +42,30 @@ def forward_frame(name):
     socketio.emit('response', 'Success')
 
 
+@socketio.on("Seek")
+def seek_frame(data):
+    """
+    This function pauses the session on a given frame, either
+    {"name", "frame"} or {"name", "class", "interval"} to jump to the
+    best frame of an interval returned by /timeline
+    """
+    room = data['name']
+    session = users.get(room)
+    frame_index = data.get('frame')
+
+    if session and frame_index is None and session.timeline:
+        labels = {name: label for label, name in Server.MODEL.names.items()}
+        interval = session.timeline.interval(labels.get(data.get('class')), int(data.get('interval', 0)))
+        frame_index = interval[3] if interval else None
+
+    if session and frame_index is not None:
+        session.seek(int(frame_index))
+        socketio.emit('response', 'Success')
+        return
+
+    socketio.emit('response', 'Frame not found')
+
+
 @socketio.on("Pause")
 def pause_session(name):
     """
@@ -60,7 +91,7 @@ def unpause_session(name):
 def stop_thread(name):
     """
     This will stop the current running thread by 
-    setting the flag to True
+    moving the session to the stopped state
     """
     room = name
     if users.get(room):
@@ -69,10 +100,22 @@ def stop_thread(name):
 
 
 @socketio.on('join')
-def create_new_socket(name):
-    room = name
+def create_new_socket(data):
+    """
+    Creates the session of the room. The payload is either the room name
+    or {"name", "binary", "quality", "stats"} to receive frames as binary
+    JPEG attachments instead of base64 strings, and Frame_Stats after
+    every frame in review mode as well
+    """
+    room = data['name'] if isinstance(data, dict) else data
     join_room(room)
+    if users.get(room):
+        users[room].stop() # a session left running by the previous join would hold its worker
     users[room] = Server(room, None, socketio)
+    if isinstance(data, dict):
+        users[room].binary_frames = bool(data.get('binary', False))
+        users[room].jpeg_quality = int(data.get('quality', Server.JPEG_QUALITY))
+        users[room].frame_stats = bool(data.get('stats', False))
     socketio.emit('response', 'Success')
 
 
@@ -85,7 +128,10 @@ def leave(name):
        return
     
     leave_room(room)
+    users[room].stop() # frees the worker, a session at the end of the video waits paused
     del users[room]
+    SessionMetrics.remove(room)
+    Storage.clean_room(room, app.config["FOOTAGE_FOLDER"], app.config["UPLOAD_FOLDER"])
     socketio.emit('response', 'Success')
 
 @socketio.on('start-session')
@@ -95,8 +141,18 @@ def start_session(data):
     diagnosis = data['diagnosis']
     is_save = data['save_value']
     video_path = data['video_path']
+    mode = data.get('mode', Server.REVIEW_MODE)
+    output = data.get('output', Server.FRAME_OUTPUT)
+    stride = data.get('stride', Server.DETECTION_STRIDE)
+    motion_threshold = data.get('motion_threshold', Server.MOTION_THRESHOLD)
+    crop = data.get('crop', Server.CROP_FIELD_OF_VIEW)
     if users.get(room):
         users[room].video_path = video_path
+        users[room].mode = mode if mode in (Server.LIVE_MODE, Server.REVIEW_MODE) else Server.REVIEW_MODE
+        users[room].output = output if output in (Server.FRAME_OUTPUT, Server.DETECTIONS_OUTPUT) else Server.FRAME_OUTPUT
+        users[room].detection_stride = stride if stride == Server.ADAPTIVE_STRIDE else max(1, int(stride))
+        users[room].motion_threshold = float(motion_threshold)
+        users[room].crop_field_of_view = bool(crop)
         users[room].diagnosis = diagnosis
         users[room].save_picture = is_save
         users[room].start_extraction_thread()
@@ -114,8 +170,10 @@ def download_zip():
     """This function is responsible for downloading the zip file"""
     data = request.json
     room = data.get('name')
-    zip_filepath = Storage.download_zip(room, users[room], app.config["FOOTAGE_FOLDER"])
-    return send_file(zip_filepath, as_attachment=True), 200
+    zip_filename = f'{room}_{users[room].diagnosis}.zip'
+    stream = Storage.download_zip(room, app.config["FOOTAGE_FOLDER"])
+    return Response(stream_with_context(stream), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}), 200
 
 
 @app.route('/feedback', methods=['POST'])
@@ -132,8 +190,14 @@ def get_feedback():
         "width":users[room].frame_width
     }
 
+    source = {
+        "video":users[room].video_hash,
+        "frame":users[room].displayed_frame_index,
+        "room":room
+    }
+
     Storage.feedback(data, sizes, app.config['FEEDBACK_FOLDER'], 
-                     users[room].current_frame, users[room].current_labels)
+                     users[room].current_frame, users[room].current_labels, source)
 
     return jsonify({'message':'successful'})
 
@@ -150,30 +214,174 @@ def extract_frames():
 
     file = request.files['file']
     room = request.form['name']
-    users[room].stop_extraction_flag = False
+    users[room].reset()
 
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 404
 
     if file and Server.allowed_file(file.filename):
-        filepath = Storage.save_file(app.config["UPLOAD_FOLDER"], file)
-
-        #pylint: disable=no-member
-        cap = cv2.VideoCapture(filepath)
-        users[room].frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) 
-        users[room].frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        #pylint: enable=no-member
+        temp_path, content_hash = Storage.save_file(Storage.room_folder(app.config["UPLOAD_FOLDER"], room), file)
+        filepath, metadata = Storage.store_video(app.config["UPLOAD_FOLDER"], temp_path,
+                                                 content_hash, file.filename)
+        users[room].frame_width = metadata["width"]
+        users[room].frame_height = metadata["height"]
 
         size_message = {
         "width":users[room].frame_width,
             "height":users[room].frame_height
         }
  
-        return jsonify({"ack": True, "filepath": filepath, "size":size_message}), 200
+        return jsonify({"ack": True, "filepath": filepath, "hash": content_hash, "size":size_message}), 200
 
     return jsonify({'ack':False, 'error': 'Invalid file format'}), 404
 
 
+@app.route('/uploads', methods=["POST"])
+def create_upload():
+    """
+    This function starts a chunked upload of a video. The chunks are then
+    sent in order with PUT /uploads/<upload_id>?offset=<bytes already sent>
+    and the upload is completed with POST /uploads/<upload_id>/finalize
+    """
+    data = request.json
+    filename = data.get('filename', '')
+    room = data.get('name', '')
+
+    if not Server.allowed_file(filename):
+        return jsonify({'ack':False, 'error': 'Invalid file format'}), 404
+
+    upload = ChunkedUpload.create(Storage.room_folder(app.config["UPLOAD_FOLDER"], room), filename, room)
+    return jsonify({"upload_id": upload.upload_id, "offset": upload.received}), 200
+
+
+@app.route('/uploads/<upload_id>', methods=["GET"])
+def upload_status(upload_id):
+    """
+    This function tells the client from which offset to resume an upload
+    """
+    upload = ChunkedUpload.get(app.config["UPLOAD_FOLDER"], upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    return jsonify({"upload_id": upload_id, "offset": upload.received}), 200
+
+
+@app.route('/uploads/<upload_id>', methods=["PUT"])
+def upload_chunk(upload_id):
+    """
+    This function streams the body of the request to the end of the upload
+    """
+    upload = ChunkedUpload.get(app.config["UPLOAD_FOLDER"], upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    offset = request.args.get('offset', type=int)
+    received = upload.write(offset, request.stream)
+    if received is None:
+        return jsonify({'error': 'Offset mismatch', 'offset': upload.received}), 409
+
+    return jsonify({"upload_id": upload_id, "offset": received}), 200
+
+
+@app.route('/uploads/<upload_id>/finalize', methods=["POST"])
+def finalize_upload(upload_id):
+    """
+    This function completes an upload, probing the video once and caching
+    its metadata. It answers like /send-videos
+    """
+    upload = ChunkedUpload.get(app.config["UPLOAD_FOLDER"], upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    temp_path, content_hash = upload.finalize()
+    filepath, metadata = Storage.store_video(app.config["UPLOAD_FOLDER"], temp_path,
+                                             content_hash, upload.filename)
+
+    if users.get(upload.room):
+        users[upload.room].reset()
+        users[upload.room].frame_width = metadata["width"]
+        users[upload.room].frame_height = metadata["height"]
+
+    size_message = {
+        "width":metadata["width"],
+        "height":metadata["height"]
+    }
+
+    return jsonify({"ack": True, "filepath": filepath, "hash": content_hash, "size":size_message}), 200
+
+
+@app.route('/jobs', methods=["POST"])
+def start_analysis():
+    """
+    This function starts analysing a whole uploaded video in the background,
+    sessions on that video then read the detections instead of inferring.
+    The body is {"video_path", "crop"}, crop runs the model on the field
+    of view only
+    """
+    data = request.json
+    video_path = data.get('video_path', '')
+    crop = bool(data.get('crop', Server.CROP_FIELD_OF_VIEW))
+    upload_folder = os.path.abspath(app.config["UPLOAD_FOLDER"])
+
+    if os.path.dirname(os.path.abspath(video_path)) != upload_folder:
+        return jsonify({'error': 'Video not found'}), 404
+
+    metadata = Storage.read_metadata(video_path)
+    if not metadata or not Storage.acquire_video(video_path):
+        return jsonify({'error': 'Video not found'}), 404
+
+    job = AnalysisJob.start(video_path, metadata, Server.SCHEDULER, Server.detections_key_for(metadata["hash"]),
+                            Server.detections_path(metadata["hash"]), crop)
+    return jsonify(job.status()), 200
+
+
+@app.route('/jobs', methods=["GET"])
+def list_analyses():
+    """
+    This function reports the progress and throughput of every job
+    """
+    return jsonify([job.status() for job in AnalysisJob.all()]), 200
+
+
+@app.route('/jobs/<job_id>', methods=["GET"])
+def analysis_status(job_id):
+    job = AnalysisJob.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job.status()), 200
+
+
+@app.route('/timeline/<video_hash>', methods=["GET"])
+def detection_timeline(video_hash):
+    """
+    This function returns the detection intervals of a video per class
+    (start/end frame, peak confidence, best frame), merged from the
+    per-frame detections computed so far
+    """
+    if not re.fullmatch(r'[0-9a-f]{64}', video_hash):
+        return jsonify({'error': 'Video not found'}), 404
+
+    # the timeline of a video being played or analysed, else one read from its stored index
+    timeline = DetectionTimeline.get(Server.detections_key_for(video_hash))
+    if timeline is None:
+        index_path = Server.detections_path(video_hash)
+        if not os.path.exists(index_path):
+            return jsonify({'error': 'Video not found'}), 404
+        timeline = DetectionTimeline.from_detections(DetectionCache.load(index_path))
+    return jsonify({"hash": video_hash, "intervals": timeline.to_dict(Server.MODEL.names)}), 200
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """
+    This function exposes the per-room stage latencies, frame and
+    dropped-frame counters and FPS, and the model load timings of the
+    boot, in the Prometheus text format
+    """
+    return Response(SessionMetrics.exposition(STARTUP_TIMINGS), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 @app.route('/register-service')
 @app.route('/session')
@@ -188,6 +396,12 @@ if __name__ == '__main__':
     if not os.path.exists(app.config['FOOTAGE_FOLDER']):
         os.makedirs(app.config['FOOTAGE_FOLDER'])
 
+    sweeper = StorageSweeper(app.config['UPLOAD_FOLDER'], app.config['FOOTAGE_FOLDER'],
+                             active_rooms=lambda: list(users),
+                             active_videos=lambda: [user.video_path for user in list(users.values())]
+                                 + [job.video_path for job in AnalysisJob.all() if job.state in (AnalysisJob.QUEUED, AnalysisJob.RUNNING)])
+    sweeper.start()
+
     socketio.run(app,debug=True,
                  host='0.0.0.0', port = 8000,
                  allow_unsafe_werkzeug=True)
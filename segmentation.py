@@ -1,16 +1,83 @@
+import os
+import sys
+import time
+import hashlib
+import numpy as np
 import torch
 from PIL import Image
 import io
 
+YOLOV5_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yolov5')
+if YOLOV5_DIR not in sys.path:
+    sys.path.append(YOLOV5_DIR)
 
-def get_yolov5():
-    model = torch.hub.load('./yolov5', 'custom',
-                           path='./model/best.pt', source='local',force_reload=True, _verbose=False)
+MODEL_PATH = './model/best.pt'
+MODEL_CACHE_FOLDER = './model/cache'
+STARTUP_TIMINGS = {} # seconds spent in each step of the last model load
+
+
+def hash_weights(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_fused_model(weights):
+    """Returns the fused detection model of the weights. The fused model is
+    saved under model/cache keyed by the hash of the weights, so a restart
+    only unpickles it, and retraining (new weights) invalidates it. Returns
+    the model and the hash of the weights"""
+    from models.experimental import attempt_load
+
+    start = time.perf_counter()
+    weights_hash = hash_weights(weights)
+    cache_path = os.path.join(MODEL_CACHE_FOLDER, f"{weights_hash}.pt")
+    STARTUP_TIMINGS['hash'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    STARTUP_TIMINGS['cache_hit'] = os.path.exists(cache_path)
+    if STARTUP_TIMINGS['cache_hit']:
+        model = torch.load(cache_path, map_location='cpu')['model']
+    else:
+        model = attempt_load(weights, device='cpu', fuse=True)
+        os.makedirs(MODEL_CACHE_FOLDER, exist_ok=True)
+        torch.save({'model': model}, f"{cache_path}.tmp")
+        os.replace(f"{cache_path}.tmp", cache_path)
+    STARTUP_TIMINGS['load'] = time.perf_counter() - start
+    return model, weights_hash
+
+
+def get_yolov5(weights=MODEL_PATH):
+    from models.common import AutoShape
+
+    boot = time.perf_counter()
+    fused_model, weights_hash = load_fused_model(weights)
+    model = AutoShape(fused_model, verbose=False)
     model.conf = 0.5
+    model.weights_hash = weights_hash # detections stored by the server are only valid for these weights
     #model.cuda()
+
+    start = time.perf_counter()
+    model(np.zeros((640, 640, 3), dtype=np.uint8)) # warm up so the first real frame is not slower
+    STARTUP_TIMINGS['warmup'] = time.perf_counter() - start
+    STARTUP_TIMINGS['total'] = time.perf_counter() - boot
+    print(f"Model ready in {STARTUP_TIMINGS['total']:.2f}s "
+          f"({'cached' if STARTUP_TIMINGS['cache_hit'] else 'fused'} {weights})")
     return model
 
 
+def detections_from_boxes(model, image, boxes):
+    """Wraps already known boxes ((n, 6) array of xyxy, conf, class) of an
+    RGB image into a Detections object, as if the model had returned them"""
+    from models.common import Detections
+    from utils.general import Profile
+    pred = [torch.from_numpy(boxes)]
+    return Detections([image], pred, ['image0.jpg'], times=(Profile(), Profile(), Profile()),
+                      names=model.names, shape=(1, 3, *image.shape[:2]))
+
+
 def get_image_from_bytes(binary_image, max_size=1024):
     input_image = Image.open(io.BytesIO(binary_image)).convert("RGB")
     width, height = input_image.size
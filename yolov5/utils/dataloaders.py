@@ -433,6 +433,18 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+def manifest_weights(path):
+    # Sampling weight of each image listed in the 'manifest.jsonl' of dataset directories, i.e. {"image": "images/1.jpg", "weight": 10}
+    weights = {}
+    for p in path if isinstance(path, list) else [path]:
+        manifest = Path(p) / 'manifest.jsonl'
+        if manifest.is_file():
+            with open(manifest) as f:
+                for x in (json.loads(line) for line in f if line.strip()):
+                    weights[str((Path(p) / x['image']).resolve())] = int(x.get('weight', 1))
+    return weights
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
     cache_version = 0.6  # dataset labels *.cache version
@@ -569,6 +581,11 @@ class LoadImagesAndLabels(Dataset):
 
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
+        # Oversample weighted images (i.e. feedback samples) instead of reading physical copies
+        weights = manifest_weights(path)
+        if weights:
+            self.indices = [i for i, f in enumerate(self.im_files) for _ in range(weights.get(str(Path(f).resolve()), 1))]
+
         # Cache images into RAM/disk for faster training
         if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
             cache_images = False
@@ -645,7 +662,7 @@ class LoadImagesAndLabels(Dataset):
         return x
 
     def __len__(self):
-        return len(self.im_files)
+        return len(self.indices)
 
     # def __iter__(self):
     #     self.count = -1